@@ -0,0 +1,328 @@
+"""Throughput / latency benchmark for the serial capture pipeline.
+
+A pseudo-terminal pair stands in for the serial port: SerialThread reads the slave end while a generator
+thread writes README style thermocouple lines (or synthetic N channel lines) into the master end.
+Runs headless on any Linux box, no hardware needed.
+
+    python3 benchmarks/bench_capture.py --rate 20000 --duration 10
+    python3 benchmarks/bench_capture.py --channels 16 --rate 0 --protocol binary
+    python3 benchmarks/bench_capture.py --channels 16 --rate 0 --storage columnar
+    python3 benchmarks/bench_capture.py --ports 4 --rate 5000
+    python3 benchmarks/bench_capture.py --callback-rows 10000,100000,1000000
+"""
+import argparse
+import binascii
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tty
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import capture_engine as engine  # noqa: E402
+
+README_LINE = ('{{"s01_time_ms": {t}, "s01_tempHJ_C": {a:e}, "s01_tempCJ_C": 2.025000e+01, '
+               '"s02_time_ms": {t}, "s02_tempHJ_C": {b:e}, "s02_tempCJ_C": 2.000000e+01, "bench_send_ns": {ns}}}')
+
+STORES = {store.NAME: store for store in [engine.SqliteStore, engine.ColumnarStore]}
+
+
+def make_header(channels):
+    if channels == 0:
+        names = [('s01_time_ms', 'integer'), ('s01_tempHJ_C', 'real'), ('s01_tempCJ_C', 'real'),
+                 ('s02_time_ms', 'integer'), ('s02_tempHJ_C', 'real'), ('s02_tempCJ_C', 'real')]
+    else:
+        names = [('time_ms', 'integer')] + [(f'ch{i:02d}', 'real') for i in range(channels)]
+    names.append(('bench_send_ns', 'integer'))
+    return [{'pos': i, 'name': name, 'fmt': fmt} for i, (name, fmt) in enumerate(names)]
+
+
+def cobs_encode(payload):
+    out = bytearray()
+    block = bytearray()
+    for b in payload + b'\x00':
+        if b == 0:
+            out.append(len(block) + 1)
+            out += block
+            block = bytearray()
+        else:
+            block.append(b)
+            if len(block) == 254:
+                out.append(0xFF)
+                out += block
+                block = bytearray()
+    return bytes(out) + b'\x00'
+
+
+class Generator(threading.Thread):
+
+    def __init__(self, fd, header, rate, duration, protocol, pad):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.header = header
+        self.rate = rate
+        self.duration = duration
+        self.protocol = protocol
+        self.pad = pad
+        self.sent = 0
+        self.bytes = 0
+        self.cpu = float('nan')
+        self.readme = header[0]['name'] == 's01_time_ms'
+        if protocol == 'binary':
+            # bench_send_ns does not fit int32, the binary layout sends it as the low 31 bits
+            self.struct = struct.Struct('<' + ''.join('i' if h['fmt'] == 'integer' else 'f' for h in header))
+
+    def line(self, i, ns):
+        t = i
+        if self.protocol == 'binary':
+            values = [t if h['fmt'] == 'integer' else np.sin(i / 100) for h in self.header]
+            values[-1] = ns & 0x7FFFFFFF
+            rec = self.struct.pack(*values)
+            return cobs_encode(rec + struct.pack('<H', binascii.crc_hqx(rec, 0xFFFF)))
+        if self.readme:
+            text = README_LINE.format(t=t, a=20 + np.sin(i / 100), b=19, ns=ns)
+        else:
+            values = ', '.join(f'"{h["name"]}": {np.sin(i / 100 + k):e}' for k, h in enumerate(self.header[1:-1]))
+            text = f'{{"time_ms": {t}, {values}, "bench_send_ns": {ns}}}'
+        return (text + ' ' * self.pad + '\n').encode()
+
+    def run(self):
+        t0 = time.monotonic()
+        while True:
+            elapsed = time.monotonic() - t0
+            if elapsed >= self.duration:
+                break
+            target = int(self.rate * elapsed) if self.rate else self.sent + 1000
+            n = min(target - self.sent, 5000)
+            if n <= 0:
+                time.sleep(0.001)
+                continue
+            ns = time.monotonic_ns()
+            data = b''.join(self.line(self.sent + k, ns) for k in range(n))
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            self.sent += n
+            self.bytes += len(data)
+        self.cpu = time.thread_time()
+
+
+def thread_cpu(tid):
+    # user + system seconds of one thread from /proc, the whole process without a thread id
+    if tid is None:
+        return time.process_time()
+    try:
+        fields = Path(f'/proc/self/task/{tid}/stat').read_text().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return float('nan')
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def run_capture(args, workdir):
+    # one pty pair, reader, generator and capture per port, every capture behind the one writer
+    header = make_header(args.channels)
+    ptys = [os.openpty() for _ in range(args.ports)]
+    captures, readers, gens = [], [], []
+    for i, (master, slave) in enumerate(ptys):
+        tty.setraw(slave)
+        port = os.ttyname(slave)
+        filename = str(Path(workdir) / f'bench{i}{STORES[args.storage].SUFFIX}')
+        captures.append(engine.Capture(filename, header, protocol=args.protocol, key=port))
+        readers.append(engine.SerialThread(port, baud=args.baud, protocol=args.protocol))
+        gens.append(Generator(master, header, args.rate, args.duration, args.protocol, args.pad))
+
+    writer = engine.StoreWriter(captures)
+    engine.ENGINE.writer = writer
+    writer.start()
+    for reader in readers:
+        reader.start()
+    time.sleep(0.1)
+    threads = [('writer', writer)] + [('reader', reader) for reader in readers]
+    # Thread.native_id is 3.8+, on 3.7 only the process total (generators included) is available
+    tids = [getattr(t, 'native_id', None) for _, t in threads]
+    if None in tids:
+        threads, tids = [('process', None)], [None]
+    cpu0 = [thread_cpu(tid) for tid in tids]
+    t0 = time.monotonic()
+    for gen in gens:
+        gen.start()
+
+    max_queue = 0
+    while any(gen.is_alive() for gen in gens):
+        max_queue = max(max_queue, engine.Q.qsize())
+        time.sleep(0.05)
+    # let the readers catch up with what is still in the ptys
+    deadline = time.monotonic() + 10
+    while any(reader.ser_obj.in_waiting for reader in readers) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.2)
+    wall = time.monotonic() - t0
+    cpu1 = [thread_cpu(tid) for tid in tids]
+    for reader in readers:
+        reader.stop()
+    writer.stop()
+    for master, _ in ptys:
+        os.close(master)
+
+    names = ['host_mono_ns', 'bench_send_ns']
+    lat = []
+    for capture in captures:
+        cols = list(engine.read_columns(engine.Catalog.load(capture.filename), names))
+        lat.append(np.column_stack([np.concatenate([c[name] for c in cols]).astype(np.int64) if cols
+                                    else np.empty(0, np.int64) for name in names]))
+    lat = np.concatenate(lat)
+    if args.protocol == 'binary':
+        lat = (lat[:, 0] & 0x7FFFFFFF) - lat[:, 1]
+        lat[lat < 0] += 0x80000000
+    else:
+        lat = lat[:, 0] - lat[:, 1]
+    size = sum(p.stat().st_size for p in Path(workdir).rglob('*') if p.is_file())
+
+    errors = {}
+    for capture in captures:
+        for k, v in capture.parser.errors().items():
+            errors[k] = errors.get(k, 0) + v
+    cpu = {}
+    for (name, _), c0, c1 in zip(threads, cpu0, cpu1):
+        cpu[name] = cpu.get(name, 0) + c1 - c0
+    sent = sum(gen.sent for gen in gens)
+    return {
+        'protocol': args.protocol,
+        'storage': args.storage,
+        'ports': args.ports,
+        'rate_target': args.rate,
+        'lines_sent': sent,
+        'bytes_sent': sum(gen.bytes for gen in gens),
+        'rows_written': writer.row_count,
+        'dropped': sent - writer.row_count,
+        'parse_errors': errors,
+        'lines_per_s': writer.row_count / wall,
+        'bytes_per_s': sum(gen.bytes for gen in gens) / wall,
+        'max_queue_batches': max_queue,
+        'latency_ms': dict(zip(['p50', 'p90', 'p99', 'max'],
+                               (np.percentile(lat, [50, 90, 99, 100]) / 1e6).round(3).tolist())) if len(lat) else {},
+        'cpu_s': {'generator': sum(gen.cpu for gen in gens), **cpu},
+        'store_bytes': size,
+        'store_bytes_per_row': size / max(writer.row_count, 1),
+        'store_batch_ms_p99': engine.METRICS.snapshot()['histograms'].get(
+            'store_batch_seconds', {}).get('p99', 0) * 1e3,
+        'commit_ms_p99': engine.METRICS.snapshot()['histograms'].get(
+            f'{STORES[args.storage].NAME}_commit_seconds', {}).get('p99', 0) * 1e3,
+    }
+
+
+def run_callbacks(args, workdir):
+    # wall time of the readout and figure callbacks, dispatched through dash as the browser would
+    import dash
+    import data_capture as dc
+    app = dash.Dash(__name__)
+    app.layout = dc.layout
+    dc.add_dash(app)
+    client = app.server.test_client()
+    client.get('/')
+
+    header = make_header(args.channels)
+    names = [h['name'] for h in header]
+    filename = str(Path(workdir) / 'callbacks.db')
+    writer = engine.StoreWriter([engine.Capture(filename, header, key='bench')])
+    engine.ENGINE.writer = writer
+    writer.start()
+    gen = Generator(None, header, 0, 0, 'json', 0)
+
+    def post(key, outputs, inputs, state, changed):
+        output = next(k for k in app.callback_map if key in k)
+        body = {'output': output, 'outputs': outputs, 'inputs': inputs, 'state': state, 'changedPropIds': [changed]}
+        t0 = time.perf_counter()
+        r = client.post('/_dash-update-component', json=body)
+        dt = time.perf_counter() - t0
+        assert r.status_code in (200, 204), r.data[:500]
+        return dt, len(r.data)
+
+    results = []
+    done = 0
+    ts = 0
+    for target in sorted(int(float(n)) for n in args.callback_rows.split(',')):
+        while done < target:
+            n = min(50000, target - done)
+            engine.Q.put(([gen.line(done + k, 0).decode() for k in range(n)], time.monotonic_ns(), time.time_ns(),
+                      'bench'))
+            done += n
+        while writer.row_count < target:
+            time.sleep(0.05)
+        rec = {'rows': target}
+        for live in (True, False):
+            engine.ENGINE.writer = writer if live else None
+            ts += 1
+            y = names[1:3]
+            fig_id = {'index': 1, 'type': f'{dc.APP_ID}_plot_graph'}
+            store = [{'id': f'{dc.APP_ID}_store', 'property': 'data', 'value': writer.rows_received if live else None}]
+            # a second page refreshed by the same push shares the first one's snapshot
+            for page in ['', '_page2'] if live else ['']:
+                rec[('figure_live' if live else 'figure_file') + page + '_ms'], rec['figure_bytes'] = post(
+                    'plot_graph',
+                    [{'id': fig_id, 'property': 'figure'}, {'id': fig_id, 'property': 'extendData'},
+                     {'id': {'index': 1, 'type': f'{dc.APP_ID}_plot_state'}, 'property': 'data'}],
+                    [{'id': f'{dc.APP_ID}_store', 'property': 'modified_timestamp', 'value': ts},
+                     {'id': {'index': 1, 'type': f'{dc.APP_ID}_plot_x_data'}, 'property': 'value', 'value': 'index'},
+                     {'id': {'index': 1, 'type': f'{dc.APP_ID}_plot_y_data'}, 'property': 'value', 'value': y},
+                     {'id': fig_id, 'property': 'relayoutData', 'value': None}],
+                    [{'id': {'index': 1, 'type': f'{dc.APP_ID}_plot_state'}, 'property': 'data', 'value': None},
+                     {'id': f'{dc.APP_ID}_filename_input', 'property': 'value', 'value': filename},
+                     {'id': f'{dc.APP_ID}_header_dt', 'property': 'data', 'value': header}] + store,
+                    f'{dc.APP_ID}_store.modified_timestamp')
+            rec['readouts_live_ms' if live else 'readouts_file_ms'], _ = post(
+                'readout_card',
+                [{'id': {'index': name, 'type': f'{dc.APP_ID}_readout_card'}, 'property': 'children'} for name in y],
+                [{'id': f'{dc.APP_ID}_store', 'property': 'modified_timestamp', 'value': ts},
+                 {'id': f'{dc.APP_ID}_readouts_window_dropdown', 'property': 'value', 'value': dc.STATS_WINDOWS[1]}],
+                [{'id': f'{dc.APP_ID}_filename_input', 'property': 'value', 'value': filename},
+                 {'id': f'{dc.APP_ID}_header_dt', 'property': 'data', 'value': header}] + store,
+                f'{dc.APP_ID}_store.modified_timestamp')
+        for k in list(rec):
+            if k.endswith('_ms'):
+                rec[k] = round(rec[k] * 1e3, 2)
+        results.append(rec)
+        print(f'  {rec}', flush=True)
+    writer.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=20000, help='lines per second, 0 = as fast as possible')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of generated data')
+    parser.add_argument('--channels', type=int, default=0,
+                        help='synthetic channels per line, 0 = README thermocouple format')
+    parser.add_argument('--pad', type=int, default=0, help='spaces appended to every line to grow its size')
+    parser.add_argument('--protocol', choices=['json', 'binary'], default='json')
+    parser.add_argument('--storage', choices=list(STORES), default='sqlite')
+    parser.add_argument('--ports', type=int, default=1, help='pty pairs captured at once, each at --rate')
+    parser.add_argument('--baud', type=int, default=921600, help='passed to the port, a pty ignores it')
+    parser.add_argument('--callback-rows', default='',
+                        help='comma separated row counts to time the readout / figure callbacks at, e.g. 1e4,1e5,1e6')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f'capture: {args.protocol} into {args.storage}, {args.ports} x {args.rate:g} lines/s '
+              f'for {args.duration:g}s', flush=True)
+        results['capture'] = run_capture(args, workdir)
+        for k, v in results['capture'].items():
+            print(f'  {k}: {v}')
+        if args.callback_rows:
+            print('callbacks:', flush=True)
+            results['callbacks'] = run_callbacks(args, workdir)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2611 @@
+"""Capture engine: serial readers, parsers, the writer thread and the capture file formats.
+
+Needs numpy and pyserial only, so it can log unattended without the web stack.  data_capture.py drives the
+engine in its own process, or attaches to one started from the command line with --api:
+
+    python3 capture_engine.py --port /dev/ttyUSB0 --file data/run.db
+    python3 capture_engine.py --port /dev/ttyUSB0 --port /dev/ttyUSB1 --api 127.0.0.1:8051
+    python3 capture_engine.py --api 127.0.0.1:8051
+    python3 data_capture.py --engine http://127.0.0.1:8051
+"""
+import numpy as np
+
+from threading import Thread, Lock, Condition, Event
+import queue
+import sys
+import struct
+import base64
+import serial
+import serial.tools.list_ports
+
+import time
+from pathlib import Path
+import json
+import sqlite3
+import binascii
+import re
+import ast
+import argparse
+import signal
+from bisect import bisect_left
+from collections import deque
+from functools import wraps
+from operator import itemgetter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# faster json decoders are used when installed, the parser only needs loads()
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
+
+# readout statistics are kept over the newest this many samples of each channel
+STATS_WINDOWS = [100, 1000, 10000]
+# host receive stamps appended to every row, taken when the read returned
+HOST_HEADER = [{'name': 'host_time_s', 'fmt': 'real'}, {'name': 'host_mono_ns', 'fmt': 'integer'}]
+BAUD_RATES = [9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600, 1000000, 2000000]
+
+class Counter:
+
+    # totals plus per-second bins over the last WINDOW seconds for a rate
+    WINDOW = 10
+
+    def __init__(self):
+        self.total = 0
+        self._bins = [0] * self.WINDOW
+        self._sec = int(time.monotonic())
+
+    def _roll(self, now):
+        sec = int(now)
+        if sec != self._sec:
+            for s in range(self._sec + 1, min(sec, self._sec + self.WINDOW) + 1):
+                self._bins[s % self.WINDOW] = 0
+            self._sec = sec
+
+    def inc(self, n=1):
+        self._roll(time.monotonic())
+        self.total += n
+        self._bins[self._sec % self.WINDOW] += n
+
+    def rate(self):
+        # complete seconds only, the current one is still filling
+        self._roll(time.monotonic())
+        return (sum(self._bins) - self._bins[self._sec % self.WINDOW]) / (self.WINDOW - 1)
+
+
+class Histogram:
+
+    # log2 buckets from 10 us to ~80 s
+    BOUNDS = [1e-5 * 2 ** k for k in range(24)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS + [self.max], self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+
+    PREFIX = 'ohdaq_'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, n=1):
+        with self.lock:
+            counter = self.counters.get(name)
+            if counter is None:
+                counter = self.counters[name] = Counter()
+            counter.inc(n)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(seconds)
+
+    def gauge(self, name, fn):
+        # fn is called at scrape time, it should return a number or None
+        self.gauges[name] = fn
+
+    def timed(self, func):
+        # wall time of completed calls, PreventUpdate and errors are not timed
+        name = f'{func.__name__}_seconds'
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            out = func(*args, **kwargs)
+            self.observe(name, time.perf_counter() - t0)
+            return out
+        return wrapper
+
+    def seconds(self, names):
+        # total time observed so far under the named histograms
+        with self.lock:
+            return sum(self.histograms[name].sum for name in names if name in self.histograms)
+
+    def snapshot(self):
+        out = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        with self.lock:
+            for name, c in self.counters.items():
+                out['counters'][name] = {'total': c.total, 'per_second': c.rate()}
+            for name, h in self.histograms.items():
+                out['histograms'][name] = {'count': h.count, 'sum': h.sum, 'max': h.max,
+                                           'p50': h.quantile(0.5), 'p90': h.quantile(0.9),
+                                           'p99': h.quantile(0.99)}
+        for name, fn in list(self.gauges.items()):
+            try:
+                out['gauges'][name] = fn()
+            except Exception:
+                out['gauges'][name] = None
+        return out
+
+    def text(self):
+        # prometheus text exposition format
+        snap = self.snapshot()
+        lines = []
+        for name, c in sorted(snap['counters'].items()):
+            lines += [f'# TYPE {self.PREFIX}{name}_total counter',
+                      f'{self.PREFIX}{name}_total {c["total"]}',
+                      f'# TYPE {self.PREFIX}{name}_per_second gauge',
+                      f'{self.PREFIX}{name}_per_second {c["per_second"]:g}']
+        for name, v in sorted(snap['gauges'].items()):
+            if v is not None:
+                lines += [f'# TYPE {self.PREFIX}{name} gauge', f'{self.PREFIX}{name} {v:g}']
+        for name, h in sorted(snap['histograms'].items()):
+            lines.append(f'# TYPE {self.PREFIX}{name} summary')
+            for q in ['p50', 'p90', 'p99']:
+                lines.append(f'{self.PREFIX}{name}{{quantile="0.{q[1:]}"}} {h[q]:g}')
+            lines += [f'{self.PREFIX}{name}_sum {h["sum"]:g}', f'{self.PREFIX}{name}_count {h["count"]}']
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class CaptureQueue:
+
+    # what put() does when the queue already holds max_lines lines:
+    #   block: wait for the writer, drop-oldest: discard the oldest batches, spill: append to a journal file
+    POLICIES = ['block', 'drop-oldest', 'spill']
+    MAX_LINES = 500000
+    # journal records are a little-endian length and a json batch. <journal>.offset holds where the batches not
+    # committed yet start, so a capture resumed after a crash replays only those
+    SPILL_LENGTH = struct.Struct('<I')
+
+    def __init__(self, max_lines=MAX_LINES, policy='block', spill_path=None):
+        self.cond = Condition()
+        self._batches = deque()
+        self.lines = 0
+        self._spill_w = None
+        self._spill_r = None
+        self.configure(max_lines, policy, spill_path)
+
+    def configure(self, max_lines=MAX_LINES, policy='block', spill_path=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown overflow policy: {policy}')
+        with self.cond:
+            # batches a failed writer left behind belong to the previous capture
+            if self.lines:
+                METRICS.inc('queue_dropped_lines', self.lines)
+            self._batches.clear()
+            self.lines = 0
+            self._abandoned = False
+            self._close_spill()
+            self.max_lines = max_lines
+            self.policy = policy
+            self.spill_path = spill_path
+            self._spilled = 0
+            self._taken = self._confirmed = 0
+            if spill_path and Path(spill_path).exists():
+                # journal left by a capture that did not stop cleanly, replay what it did not commit before
+                # anything new
+                self._resume_spill()
+            self.cond.notify_all()
+
+    def _resume_spill(self):
+        offset_path = Path(self.spill_path + '.offset')
+        try:
+            offset = int(offset_path.read_text())
+        except (OSError, ValueError):
+            offset = 0
+        self._spill_r = open(self.spill_path, 'rb')
+        self._spill_r.seek(offset)
+        end = offset
+        while self._read_spilled() is not None:
+            self._spilled += 1
+            end = self._spill_r.tell()
+        if not self._spilled:
+            self._close_spill()
+            self._remove_spill()
+            return
+        # a record cut off by the crash is dropped, new ones are appended after the last whole one
+        self._spill_w = open(self.spill_path, 'r+b')
+        self._spill_w.truncate(end)
+        self._spill_w.seek(end)
+        self._spill_r.seek(offset)
+        self._taken = self._confirmed = offset
+
+    def _close_spill(self):
+        for f in [self._spill_w, self._spill_r]:
+            if f is not None:
+                f.close()
+        self._spill_w = self._spill_r = None
+
+    def _remove_spill(self):
+        for path in [Path(self.spill_path), Path(self.spill_path + '.offset')]:
+            if path.exists():
+                path.unlink()
+
+    def put(self, batch):
+        n = len(batch[0])
+        with self.cond:
+            if self._abandoned:
+                METRICS.inc('queue_dropped_lines', n)
+                return
+            if self._spilled:
+                # keep order: once spilling, everything goes through the journal until it is replayed
+                self._spill(batch)
+                return
+            while self.lines and self.lines + n > self.max_lines:
+                METRICS.inc('queue_overflow_events')
+                if self.policy == 'drop-oldest':
+                    dropped = self._batches.popleft()
+                    self.lines -= len(dropped[0])
+                    METRICS.inc('queue_dropped_lines', len(dropped[0]))
+                elif self.policy == 'spill' and self.spill_path:
+                    self._spill(batch)
+                    return
+                else:
+                    t0 = time.perf_counter()
+                    self.cond.wait(timeout=0.5)
+                    METRICS.observe('queue_blocked_seconds', time.perf_counter() - t0)
+                    if self._abandoned:
+                        METRICS.inc('queue_dropped_lines', n)
+                        return
+            self._batches.append(batch)
+            self.lines += n
+            self.cond.notify_all()
+
+    def _spill(self, batch):
+        if self._spill_w is None:
+            self._spill_w = open(self.spill_path, 'ab')
+            self._spill_r = open(self.spill_path, 'rb')
+        lines, mono_ns, wall_ns, key = batch
+        # binary mode batches hold cobs frames
+        binary = bool(lines) and isinstance(lines[0], bytes)
+        data = json.dumps({'lines': [base64.b64encode(line).decode() for line in lines] if binary else lines,
+                           'binary': binary, 'mono_ns': mono_ns, 'wall_ns': wall_ns, 'key': key}).encode()
+        self._spill_w.write(self.SPILL_LENGTH.pack(len(data)) + data)
+        self._spill_w.flush()
+        self._spilled += 1
+        METRICS.inc('queue_spilled_lines', len(lines))
+        self.cond.notify_all()
+
+    def _read_spilled(self):
+        # next journal record as a batch, None at the end of the journal or at a record cut off
+        head = self._spill_r.read(self.SPILL_LENGTH.size)
+        if len(head) < self.SPILL_LENGTH.size:
+            return None
+        data = self._spill_r.read(self.SPILL_LENGTH.unpack(head)[0])
+        try:
+            record = json.loads(data)
+        except ValueError:
+            return None
+        lines = [base64.b64decode(line) for line in record['lines']] if record['binary'] else record['lines']
+        return lines, record['mono_ns'], record['wall_ns'], record['key']
+
+    def _replay(self):
+        batch = self._read_spilled()
+        self._taken = self._spill_r.tell()
+        self._spilled -= 1
+        return batch
+
+    def replaying(self):
+        # batches from the journal were handed out and are not confirmed yet
+        with self.cond:
+            return self._taken != self._confirmed
+
+    def confirm(self):
+        # the writer committed every batch it got so far, the journal is not replayed from before them again
+        with self.cond:
+            if self._spill_r is None:
+                return
+            if not self._spilled:
+                # journal fully replayed and committed, start over with an empty file
+                self._close_spill()
+                self._remove_spill()
+                self._taken = self._confirmed = 0
+            elif self._taken != self._confirmed:
+                tmp = Path(self.spill_path + '.offset.tmp')
+                tmp.write_text(str(self._taken))
+                tmp.replace(self.spill_path + '.offset')
+                self._confirmed = self._taken
+
+    def abandon(self):
+        # the writer can't take batches any more: drop the ones in memory and everything put until the next
+        # configure(), which also wakes a put() blocked on a full queue
+        with self.cond:
+            if self.lines:
+                METRICS.inc('queue_dropped_lines', self.lines)
+            self._batches.clear()
+            self.lines = 0
+            self._abandoned = True
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self._batches and not self._spilled:
+                self.cond.wait(timeout=timeout)
+            if self._batches:
+                batch = self._batches.popleft()
+                self.lines -= len(batch[0])
+            elif self._spilled:
+                batch = self._replay()
+            else:
+                raise queue.Empty
+            self.cond.notify_all()
+            return batch
+
+    def empty(self):
+        with self.cond:
+            return not self._batches and not self._spilled
+
+    def qsize(self):
+        with self.cond:
+            return len(self._batches) + self._spilled
+
+
+Q = CaptureQueue()
+
+
+class SerialThread(Thread):
+
+    # read timeout only bounds how long stop() waits, reads return as soon as bytes arrive
+    READ_TIMEOUT = 0.5
+    READ_CHUNK = 65536
+    MAX_LINE = 65536
+
+    def __init__(self, port, baud=115200, protocol='json'):
+        super().__init__(daemon=True)
+        self.port = port
+        self.protocol = protocol
+        self._isRunning = True
+        self._buf = bytearray()
+        self.ser_obj = serial.Serial(port=port,
+                                     baudrate=baud,
+                                     parity=serial.PARITY_NONE,
+                                     stopbits=serial.STOPBITS_ONE,
+                                     timeout=self.READ_TIMEOUT)
+
+    def run(self):
+        while self._isRunning:
+            try:
+                # block for the first byte, then take everything already buffered by the driver
+                chunk = self.ser_obj.read(1)
+                if not chunk:
+                    continue
+                n_waiting = self.ser_obj.in_waiting
+                if n_waiting:
+                    chunk += self.ser_obj.read(min(n_waiting, self.READ_CHUNK))
+                mono_ns = time.monotonic_ns()
+                wall_ns = time.time_ns()
+            except (serial.SerialException, OSError, TypeError) as e:
+                # TypeError/OSError: port closed underneath a pending read
+                if self._isRunning:
+                    METRICS.inc('serial_errors')
+                    print(f'serial read failed on {self.port}: {e}')
+                break
+            METRICS.inc('serial_bytes', len(chunk))
+            METRICS.inc('serial_reads')
+            self._buf += chunk
+            lines = self._split_frames() if self.protocol == 'binary' else self._split_lines()
+            if lines:
+                # every line completed by this read gets the read's stamp
+                Q.put((lines, mono_ns, wall_ns, self.port))
+                METRICS.inc('serial_lines', len(lines))
+
+    def _split_lines(self):
+        # frame complete lines out of the buffer, keep the trailing partial line for the next read
+        end = self._buf.rfind(b'\n')
+        if end < 0:
+            if len(self._buf) > self.MAX_LINE:
+                METRICS.inc('serial_overlong_dropped')
+                del self._buf[:]
+            return []
+        text = self._buf[:end].decode('utf-8', errors='replace')
+        del self._buf[:end + 1]
+        return [line for line in map(str.strip, text.split('\n')) if line]
+
+    def _split_frames(self):
+        # binary mode: cobs frames are delimited by zero bytes
+        end = self._buf.rfind(b'\x00')
+        if end < 0:
+            if len(self._buf) > self.MAX_LINE:
+                METRICS.inc('serial_overlong_dropped')
+                del self._buf[:]
+            return []
+        frames = bytes(self._buf[:end]).split(b'\x00')
+        del self._buf[:end + 1]
+        return [frame for frame in frames if frame]
+
+    def stop(self):
+        self._isRunning = False
+        try:
+            self.ser_obj.cancel_read()
+        except Exception:
+            pass
+        self.join(timeout=2 * self.READ_TIMEOUT)
+        self.ser_obj.close()
+        return None
+
+
+class RingBuffer:
+
+    def __init__(self, capacity, dtype=float):
+        self.capacity = capacity
+        self.count = 0
+        self._head = 0
+        # every value is written twice so the newest n values are always one contiguous slice
+        self._data = np.empty(2 * capacity, dtype=dtype)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def extend(self, values):
+        n_total = len(values)
+        if n_total == 0:
+            return
+        values = values[-self.capacity:]
+        n = len(values)
+        cap = self.capacity
+        i = self._head
+        first = min(n, cap - i)
+        self._data[i:i + first] = values[:first]
+        self._data[i + cap:i + cap + first] = values[:first]
+        rest = n - first
+        if rest:
+            self._data[:rest] = values[first:]
+            self._data[cap:cap + rest] = values[first:]
+        self._head = (i + n) % cap
+        self.count += n_total
+
+    def last(self):
+        if self.count == 0:
+            return None
+        return self._data[self._head + self.capacity - 1]
+
+    def subtract(self, value):
+        # from every value held, both copies
+        self._data -= value
+
+    def window(self, n=None):
+        # zero-copy view of the newest n values, oldest first
+        n = len(self) if n is None else min(n, len(self))
+        end = self._head + self.capacity
+        return self._data[end - n:end]
+
+
+def _column_array(values, fmt):
+    if fmt == 'text':
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+        return arr
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.array([v if isinstance(v, (int, float)) else np.nan for v in values], dtype=float)
+
+
+def rows_to_columns(rows, header, start_row):
+    # header is a list of (name, fmt), rows are tuples in header order
+    columns = {'index': np.arange(start_row, start_row + len(rows), dtype=np.int64)}
+    cols = list(zip(*rows)) if rows else [()] * len(header)
+    for (name, fmt), col in zip(header, cols):
+        columns[name] = _column_array(col, fmt)
+    return columns
+
+
+class RecentData:
+
+    CAPACITY = 10000
+
+    def __init__(self, data_header, capacity=CAPACITY):
+        self.lock = Lock()
+        self.header = [(hdr['name'], hdr['fmt']) for hdr in data_header]
+        self.rings = {'index': RingBuffer(capacity, dtype=np.int64)}
+        for name, fmt in self.header:
+            self.rings[name] = RingBuffer(capacity, dtype=self._dtype(fmt))
+        self.ints = {name for name, fmt in self.header if fmt == 'integer'}
+
+    @staticmethod
+    def _dtype(fmt):
+        # integer channels keep int64 with INT_MISSING for missing values, a float would round past 2**53
+        return {'text': object, 'integer': np.int64}.get(fmt, float)
+
+    def _values(self, name, values):
+        # what readers get: copies, integers as int64, or float with nan while any of them is missing
+        if name in self.ints:
+            return _int_values(values).copy()
+        return values.copy()
+
+    def extend(self, columns, ints):
+        # ints are the exact int64 columns of the integer channels, the other channels come from columns
+        if len(columns['index']) == 0:
+            return
+        with self.lock:
+            for name, ring in self.rings.items():
+                ring.extend(ints[name] if name in ints else columns[name])
+
+    def covers(self):
+        # True while the buffer still holds every row of the capture
+        with self.lock:
+            idx = self.rings['index']
+            return len(idx) > 0 and idx.window(len(idx))[0] == 0
+
+    def last(self, name):
+        with self.lock:
+            value = self.rings[name].last()
+            return np.nan if value is not None and name in self.ints and value == INT_MISSING else value
+
+    def since(self, start, stop, names):
+        # copies of rows [start, stop), None once the oldest of them has been overwritten. the writer keeps
+        # overwriting the rings after the lock is released, callers serialize the rows later
+        with self.lock:
+            idx = self.rings['index']
+            if len(idx) == 0:
+                return None
+            newest = int(idx.last())
+            if start < newest + 1 - len(idx) or stop > newest + 1:
+                return None
+            n = newest + 1 - start
+            return {name: self._values(name, self.rings[name].window(n)[:stop - start]) for name in names}
+
+    def columns(self, names, n=None):
+        # copies, like since()
+        with self.lock:
+            return {name: self._values(name, self.rings[name].window(n)) for name in names}
+
+    def add_channel(self, name, fmt):
+        # a channel added mid-capture, missing in the rows already held
+        with self.lock:
+            ring = RingBuffer(self.rings['index'].capacity, dtype=self._dtype(fmt))
+            n = len(self.rings['index'])
+            ring.extend(np.full(n, INT_MISSING) if fmt == 'integer' else _missing_array(fmt, n))
+            self.rings[name] = ring
+            self.header.append((name, fmt))
+            if fmt == 'integer':
+                self.ints.add(name)
+
+    def next_row(self):
+        with self.lock:
+            idx = self.rings['index']
+            return 0 if len(idx) == 0 else int(idx.last()) + 1
+
+    def read(self, start, names):
+        # (first, columns): copies of the rows from start up to the newest, first is later than start when the
+        # oldest of them have been overwritten already
+        with self.lock:
+            idx = self.rings['index']
+            newest = int(idx.last()) if len(idx) else -1
+            first = max(start, newest + 1 - len(idx))
+            n = max(newest + 1 - first, 0)
+            return first, {name: self._values(name, self.rings[name].window(n)) for name in names}
+
+
+class RollingStats:
+
+    # running statistics of one channel over its newest samples, updated once per batch so a sample costs O(1):
+    # mean / std from prefix sums of the values shifted by the first one (keeps the differences exact),
+    # min / max from per block extremes plus the partial blocks at either end of the window, an ema, and the
+    # rate of change and sample rate from the host receive time. the prefix sums are rebased on the oldest one held
+    # every capacity samples, so they stay as small as the window sums instead of growing with the capture
+    BLOCK = 64
+    EMA_SPAN = 100
+
+    def __init__(self, capacity):
+        self.lock = Lock()
+        self.capacity = capacity
+        self.count = 0
+        self.shift = None
+        self.ema = None
+        self.values = RingBuffer(capacity)
+        self.times = RingBuffer(capacity)
+        # count of finite values, sum and sum of squares up to each sample, plus the zeros before the first
+        self.prefix = {key: RingBuffer(capacity + 1) for key in ['n', 's1', 's2']}
+        for ring in self.prefix.values():
+            ring.extend(np.zeros(1))
+        self._since_rebase = 0
+        self.block_min = np.full(capacity // self.BLOCK + 2, np.nan)
+        self.block_max = np.full(capacity // self.BLOCK + 2, np.nan)
+        self.alpha = 2 / (self.EMA_SPAN + 1)
+        # samples older than this many weigh less than 1e-12 in the ema
+        k = int(np.ceil(np.log(1e-12) / np.log(1 - self.alpha)))
+        self._ema_weights = self.alpha * (1 - self.alpha) ** np.arange(k)[::-1]
+
+    def extend(self, values, times):
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        if n == 0:
+            return
+        finite = np.isfinite(values)
+        with self.lock:
+            if self.shift is None and finite.any():
+                self.shift = values[finite][0]
+            x = np.where(finite, values - (self.shift or 0.0), 0.0)
+            for key, inc in [('n', finite), ('s1', x), ('s2', x * x)]:
+                ring = self.prefix[key]
+                ring.extend(ring.last() + np.cumsum(inc))
+            self._since_rebase += n
+            if self._since_rebase >= self.capacity:
+                for ring in self.prefix.values():
+                    ring.subtract(ring.window()[0])
+                self._since_rebase = 0
+
+            blocks = np.arange(self.count, self.count + n) // self.BLOCK
+            starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+            mins = np.fmin.reduceat(values, starts)
+            maxs = np.fmax.reduceat(values, starts)
+            slots = blocks[starts] % len(self.block_min)
+            if self.count % self.BLOCK:
+                # the first block was started by the previous batch
+                mins[0] = np.fmin(mins[0], self.block_min[slots[0]])
+                maxs[0] = np.fmax(maxs[0], self.block_max[slots[0]])
+            self.block_min[slots] = mins
+            self.block_max[slots] = maxs
+
+            xs = values[finite]
+            if len(xs):
+                if self.ema is None:
+                    self.ema = xs[0]
+                k = min(len(xs), len(self._ema_weights))
+                self.ema = (1 - self.alpha) ** len(xs) * self.ema + np.dot(self._ema_weights[-k:], xs[-k:])
+
+            self.values.extend(values)
+            self.times.extend(np.asarray(times, dtype=float))
+            self.count += n
+
+    def summary(self, window):
+        # statistics of the newest window samples, None before the first one
+        with self.lock:
+            n = min(window, len(self.values))
+            if n == 0:
+                return None
+            count, s1, s2 = [self.prefix[key].last() - self.prefix[key].window(n + 1)[0] for key in ['n', 's1', 's2']]
+            mean = std = None
+            if count:
+                mean = float(self.shift + s1 / count)
+                if count > 1:
+                    std = float(np.sqrt(max(s2 - s1 * s1 / count, 0.0) / (count - 1)))
+
+            values = self.values.window(n)
+            i0, i1 = self.count - n, self.count
+            b0, b1 = -(-i0 // self.BLOCK), i1 // self.BLOCK
+            if b1 > b0:
+                full = np.arange(b0, b1) % len(self.block_min)
+                ends = np.concatenate([values[:b0 * self.BLOCK - i0], values[b1 * self.BLOCK - i0:]])
+                mn = np.fmin.reduce(np.concatenate([ends, self.block_min[full]]))
+                mx = np.fmax.reduce(np.concatenate([ends, self.block_max[full]]))
+            else:
+                mn, mx = np.fmin.reduce(values), np.fmax.reduce(values)
+
+            times = self.times.window(n)
+            dt = times[-1] - times[0]
+            roc = (values[-1] - values[0]) / dt if dt > 0 else np.nan
+            return {'n': int(count), 'mean': mean, 'std': std,
+                    'min': None if np.isnan(mn) else float(mn), 'max': None if np.isnan(mx) else float(mx),
+                    'ema': None if self.ema is None else float(self.ema),
+                    'rate_of_change': None if np.isnan(roc) else float(roc),
+                    'sample_rate': float((n - 1) / dt) if dt > 0 else None}
+
+
+# numpy functions derived channel expressions may call
+DERIVED_FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+                     'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'min': np.fmin, 'max': np.fmax}
+# python 3.7 parses numbers as ast.Num, later versions as ast.Constant (ast.Num is deprecated there)
+DERIVED_NUMBERS = (ast.Constant,) if sys.version_info >= (3, 8) else (ast.Constant, ast.Num)
+DERIVED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd) + DERIVED_NUMBERS
+
+
+def compile_derived(expr, names):
+    # arithmetic over channel names -> function of a batch's columns, evaluated once per batch with numpy
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError(f'can\'t parse {expr.strip()!r}')
+    used = []
+    calls = [node.func for node in ast.walk(tree) if isinstance(node, ast.Call)]
+    for node in ast.walk(tree):
+        if not isinstance(node, DERIVED_NODES):
+            raise ValueError(f'{expr.strip()!r}: only arithmetic, numbers, channels and '
+                             f'{", ".join(DERIVED_FUNCTIONS)} are allowed')
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in DERIVED_FUNCTIONS):
+            raise ValueError(f'{expr.strip()!r}: unknown function')
+        if isinstance(node, DERIVED_NUMBERS) and not isinstance(node.value if isinstance(node, ast.Constant)
+                                                                else node.n, (int, float)):
+            raise ValueError(f'{expr.strip()!r}: only numbers are allowed as constants')
+        if isinstance(node, ast.Name) and not any(node is func for func in calls):
+            if node.id not in names:
+                raise ValueError(f'{expr.strip()!r}: unknown channel {node.id}')
+            used.append(node.id)
+    code = compile(tree, '<derived>', 'eval')
+
+    def evaluate(columns):
+        env = dict(DERIVED_FUNCTIONS)
+        env.update((name, columns[name]) for name in used)
+        with np.errstate(all='ignore'):
+            out = np.asarray(eval(code, {'__builtins__': {}}, env), dtype=float)
+        return np.broadcast_to(out, len(columns['index'])).copy()
+    return evaluate
+
+
+class Decimator:
+
+    # level 0 aggregates BUCKET rows, each level above aggregates FACTOR buckets of the level below
+    BUCKET = 64
+    FACTOR = 4
+    LEVELS = 10
+
+    def __init__(self, names):
+        self.lock = Lock()
+        self.names = list(names)
+        self.n_rows = 0
+        n_ch = len(self.names)
+        self._n = [0] * self.LEVELS
+        self._min = [np.empty((1024, n_ch)) for _ in range(self.LEVELS)]
+        self._max = [np.empty((1024, n_ch)) for _ in range(self.LEVELS)]
+        self._sum = [np.empty((1024, n_ch)) for _ in range(self.LEVELS)]
+        self._cnt = [np.empty((1024, n_ch), dtype=np.int64) for _ in range(self.LEVELS)]
+
+    def add_channel(self, name):
+        # a channel added mid-capture, the buckets already filled have no values for it
+        with self.lock:
+            self.names.append(name)
+            for arrs, fill in ((self._min, np.nan), (self._max, np.nan), (self._sum, 0.0), (self._cnt, 0)):
+                for level, arr in enumerate(arrs):
+                    arrs[level] = np.concatenate([arr, np.full((len(arr), 1), fill, dtype=arr.dtype)], axis=1)
+
+    def bucket_size(self, level):
+        return self.BUCKET * self.FACTOR ** level
+
+    def _reserve(self, level, n):
+        cap = len(self._min[level])
+        if n <= cap:
+            return
+        while cap < n:
+            cap *= 2
+        for arrs in (self._min, self._max, self._sum, self._cnt):
+            grown = np.empty((cap, len(self.names)), dtype=arrs[level].dtype)
+            grown[:self._n[level]] = arrs[level][:self._n[level]]
+            arrs[level] = grown
+
+    def _store(self, level, first, mn, mx, sm, ct):
+        # buckets [first, first + len(mn)) replace whatever was there, the first one may be a partial bucket
+        end = first + len(mn)
+        self._reserve(level, end)
+        self._min[level][first:end] = mn
+        self._max[level][first:end] = mx
+        self._sum[level][first:end] = sm
+        self._cnt[level][first:end] = ct
+        self._n[level] = end
+
+    def extend(self, columns, start_row):
+        n = len(columns['index'])
+        if n == 0 or not self.names:
+            return
+        values = np.column_stack([columns[name] for name in self.names])
+        valid = ~np.isnan(values)
+        buckets = (start_row + np.arange(n)) // self.BUCKET
+        starts = np.r_[0, np.flatnonzero(np.diff(buckets)) + 1]
+
+        mn = np.fmin.reduceat(values, starts, axis=0)
+        mx = np.fmax.reduceat(values, starts, axis=0)
+        sm = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=0)
+        ct = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+
+        with self.lock:
+            first = int(buckets[0])
+            if first < self._n[0]:
+                # merge into the partial bucket left by the previous batch
+                mn[0] = np.fmin(mn[0], self._min[0][first])
+                mx[0] = np.fmax(mx[0], self._max[0][first])
+                sm[0] += self._sum[0][first]
+                ct[0] += self._cnt[0][first]
+            self._store(0, first, mn, mx, sm, ct)
+            self._rebuild(first)
+            self.n_rows = start_row + n
+
+    def _rebuild(self, first):
+        # rebuild only the upper buckets above level 0 buckets from first on
+        for level in range(1, self.LEVELS):
+            first = first // self.FACTOR
+            lo = first * self.FACTOR
+            hi = self._n[level - 1]
+            starts = np.arange(0, hi - lo, self.FACTOR)
+            self._store(level, first,
+                        np.fmin.reduceat(self._min[level - 1][lo:hi], starts, axis=0),
+                        np.fmax.reduceat(self._max[level - 1][lo:hi], starts, axis=0),
+                        np.add.reduceat(self._sum[level - 1][lo:hi], starts, axis=0),
+                        np.add.reduceat(self._cnt[level - 1][lo:hi], starts, axis=0))
+
+    def buckets(self, first, stop):
+        # level 0 buckets [first, stop) as {'names', 'min', 'max', 'sum', 'cnt'} copies
+        with self.lock:
+            stop = min(stop, self._n[0])
+            return {'names': list(self.names), 'min': self._min[0][first:stop].copy(),
+                    'max': self._max[0][first:stop].copy(), 'sum': self._sum[0][first:stop].copy(),
+                    'cnt': self._cnt[0][first:stop].copy()}
+
+    def load_buckets(self, first, n_rows, buckets):
+        # level 0 buckets from first on replaced by saved ones covering the rows up to n_rows, channels the
+        # saved buckets don't have are missing in them
+        cols = [buckets['names'].index(name) if name in buckets['names'] else None for name in self.names]
+        n = len(buckets['min'])
+        arrs = []
+        for key, fill, dtype in (('min', np.nan, float), ('max', np.nan, float), ('sum', 0.0, float),
+                                 ('cnt', 0, np.int64)):
+            arr = np.full((n, len(self.names)), fill, dtype=dtype)
+            for i, col in enumerate(cols):
+                if col is not None:
+                    arr[:, i] = buckets[key][:, col]
+            arrs.append(arr)
+        with self.lock:
+            if n:
+                self._store(0, first, *arrs)
+                self._rebuild(first)
+            self.n_rows = n_rows
+
+    def fetch(self, x_name, y_names, start=0, stop=None, max_points=2000):
+        # min/max envelope of rows [start, stop), two points per bucket so spikes between samples survive
+        with self.lock:
+            stop = self.n_rows if stop is None else min(stop, self.n_rows)
+            span = max(stop - start, 1)
+            level = 0
+            while level < self.LEVELS - 1 and 2 * span / self.bucket_size(level) > max_points:
+                level += 1
+            size = self.bucket_size(level)
+            b0 = start // size
+            b1 = min(-(-stop // size), self._n[level])
+
+            ys = {}
+            for name in y_names:
+                i = self.names.index(name)
+                ys[name] = np.column_stack([self._min[level][b0:b1, i], self._max[level][b0:b1, i]]).ravel()
+            if x_name == 'index':
+                x = np.arange(b0, b1) * size
+            else:
+                i = self.names.index(x_name)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    x = self._sum[level][b0:b1, i] / self._cnt[level][b0:b1, i]
+        return np.repeat(x, 2), ys
+
+
+class LineParser:
+
+    TYPES = {'integer': (int,), 'real': (float, int), 'text': (str,)}
+
+    def __init__(self, data_header):
+        self.header = []
+        # keys the header doesn't have -> type of the values seen, for the capture to add them as channels
+        self.new_keys = {}
+        self._known = set()
+        self.extend(data_header)
+        self.lines = 0
+        self.malformed = 0
+        self.partial = 0
+        self.mismatched = 0
+        self.last_error = ''
+
+    def extend(self, data_header):
+        self.header += [(hdr['name'], hdr['fmt']) for hdr in data_header]
+        self.names = [name for name, fmt in self.header]
+        self._types = tuple(self.TYPES.get(fmt, (object,)) for name, fmt in self.header)
+        # compiled once: a C-level getter for the complete-line fast path
+        getter = itemgetter(*self.names)
+        self._get = getter if len(self.names) > 1 else (lambda d: (getter(d),))
+        self.ignore(self.names)
+
+    def ignore(self, names):
+        self._known.update(names)
+        for name in names:
+            self.new_keys.pop(name, None)
+
+    def _note_keys(self, dic):
+        for name, value in dic.items():
+            if name not in self._known:
+                self.new_keys[name] = widen_fmt(self.new_keys.get(name), value)
+
+    def parse(self, lines):
+        rows = []
+        loads = fast_json.loads
+        get = self._get
+        types = self._types
+        n_names = len(self.names)
+        for line in lines:
+            try:
+                dic = loads(line)
+                row = get(dic)
+            except KeyError:
+                # missing keys become NULL
+                self.partial += 1
+                row = tuple(map(dic.get, self.names))
+                self._note_keys(dic)
+            except (ValueError, TypeError, AttributeError):
+                # not json, or json that is not an object
+                self.malformed += 1
+                self.last_error = line[:200]
+                continue
+            else:
+                if len(dic) > n_names:
+                    self._note_keys(dic)
+            if not all(map(isinstance, row, types)):
+                row = self._coerce(row, line)
+            rows.append(row)
+        self.lines += len(lines)
+        return rows
+
+    def _coerce(self, row, line):
+        out = []
+        mismatched = False
+        for v, (name, fmt), types in zip(row, self.header, self._types):
+            if v is None or isinstance(v, types):
+                out.append(v)
+            elif fmt == 'integer' and isinstance(v, float) and v.is_integer():
+                out.append(int(v))
+            else:
+                mismatched = True
+                out.append(None)
+        if mismatched:
+            self.mismatched += 1
+            self.last_error = line[:200]
+        return tuple(out)
+
+    def columns(self, rows, start_row):
+        return rows_to_columns(rows, self.header, start_row)
+
+    def errors(self):
+        return {'lines': self.lines, 'malformed': self.malformed,
+                'partial': self.partial, 'mismatched': self.mismatched}
+
+
+def cobs_decode(frame):
+    out = bytearray()
+    i = 0
+    while i < len(frame):
+        code = frame[i]
+        if code == 0 or i + code > len(frame):
+            raise ValueError('invalid cobs frame')
+        out += frame[i + 1:i + code]
+        i += code
+        if code < 0xFF and i < len(frame):
+            out.append(0)
+    return bytes(out)
+
+
+def cobs_decode_block(enc):
+    # vectorized decode of n equal length frames (n, L) -> payloads (n, L - 1) and a validity mask,
+    # only valid for payloads shorter than 254 bytes where every code byte marks a zero
+    n, length = enc.shape
+    out = np.empty((n, length - 1), dtype=np.uint8)
+    nxt = enc[:, 0].astype(np.int64)
+    ok = nxt > 0
+    for j in range(1, length):
+        col = enc[:, j]
+        hit = nxt == j
+        out[:, j - 1] = np.where(hit, 0, col)
+        nxt = np.where(hit, j + col.astype(np.int64), nxt)
+        ok &= col != 0
+    ok &= nxt == length
+    return out, ok
+
+
+def _crc16_table():
+    table = np.zeros(256, dtype=np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16_block(data):
+    # crc-16/ccitt (init 0xffff, same as binascii.crc_hqx) of every row of a (n, L) uint8 array
+    crc = np.full(len(data), 0xFFFF, dtype=np.uint16)
+    for j in range(data.shape[1]):
+        crc = (crc << 8) ^ CRC16_TABLE[(crc >> 8) ^ data[:, j]]
+    return crc
+
+
+class BinaryParser:
+
+    # packed little-endian record in header order, followed by a crc-16 of the record, cobs framed
+    FORMATS = {'integer': '<i4', 'real': '<f4'}
+
+    def __init__(self, data_header):
+        self.header = [(hdr['name'], hdr['fmt']) for hdr in data_header]
+        self.names = [name for name, fmt in self.header]
+        text = [name for name, fmt in self.header if fmt not in self.FORMATS]
+        if text:
+            raise ValueError(f'binary mode supports integer and real channels only: {", ".join(text)}')
+        self.dtype = np.dtype([(name, self.FORMATS[fmt]) for name, fmt in self.header])
+        self.frame_len = self.dtype.itemsize + 3
+        # record + crc of 254 bytes or more picks up an extra code byte for every zero free 254 byte run
+        self.max_frame_len = self.frame_len + (self.dtype.itemsize + 2) // 254
+        self.lines = 0
+        self.malformed = 0
+        self.partial = 0
+        self.mismatched = 0
+        self.last_error = ''
+        # frames have a fixed layout, the header can't grow during a capture
+        self.new_keys = {}
+
+    def parse(self, frames):
+        self.lines += len(frames)
+        if self.max_frame_len == self.frame_len <= 255:
+            records = [f for f in frames if len(f) == self.frame_len]
+            for frame in frames:
+                if len(frame) != self.frame_len:
+                    self._other(frame)
+            if not records:
+                return []
+            payload, ok = cobs_decode_block(np.frombuffer(b''.join(records), dtype=np.uint8).reshape(-1, self.frame_len))
+        else:
+            decoded = []
+            for frame in frames:
+                record = None
+                if self.frame_len <= len(frame) <= self.max_frame_len:
+                    try:
+                        record = cobs_decode(frame)
+                    except ValueError:
+                        record = b''
+                if record is None or (len(record) != self.frame_len - 1 and record.startswith(b'{')):
+                    self._other(frame)
+                else:
+                    decoded.append(record if len(record) == self.frame_len - 1 else None)
+            if not decoded:
+                return []
+            ok = np.array([record is not None for record in decoded], dtype=bool)
+            blank = b'\x00' * (self.frame_len - 1)
+            payload = np.frombuffer(b''.join(record or blank for record in decoded),
+                                    dtype=np.uint8).reshape(-1, self.frame_len - 1)
+        size = self.dtype.itemsize
+        crc = payload[:, size].astype(np.uint16) | (payload[:, size + 1].astype(np.uint16) << 8)
+        ok &= crc16_block(payload[:, :size]) == crc
+        bad = len(ok) - int(ok.sum())
+        if bad:
+            self.malformed += bad
+            self.last_error = f'{bad} frames failed cobs/crc check'
+        return np.ascontiguousarray(payload[ok, :size]).view(self.dtype).ravel().tolist()
+
+    def _other(self, frame):
+        # a frame carrying a json object is the header handshake, not a data line, anything else is corrupt
+        try:
+            text = cobs_decode(frame)
+            if text.startswith(b'{') and isinstance(json.loads(text), dict):
+                self.lines -= 1
+                return
+        except ValueError:
+            pass
+        self.malformed += 1
+        self.last_error = f'bad frame of {len(frame)} bytes'
+
+    def columns(self, rows, start_row):
+        return rows_to_columns(rows, self.header, start_row)
+
+    def errors(self):
+        return {'lines': self.lines, 'malformed': self.malformed,
+                'partial': self.partial, 'mismatched': self.mismatched}
+
+
+def make_parser(data_header, protocol='json'):
+    return BinaryParser(data_header) if protocol == 'binary' else LineParser(data_header)
+
+
+# a column's type only ever widens as values are seen
+FMT_WIDENING = ['integer', 'real', 'text']
+
+
+def value_fmt(value):
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'real'
+    return 'text'
+
+
+def widen_fmt(fmt, value):
+    new = value_fmt(value)
+    if fmt is None or new is None:
+        return fmt or new
+    return max(fmt, new, key=FMT_WIDENING.index)
+
+
+def infer_header(objects):
+    # header rows (pos, name, fmt) covering every key of the sampled json objects, in the order they first appear
+    fmts = {}
+    for obj in objects:
+        for name, value in obj.items():
+            fmts[name] = widen_fmt(fmts.get(name), value)
+    return [{'pos': i, 'name': name, 'fmt': fmt or 'text'} for i, (name, fmt) in enumerate(fmts.items())]
+
+
+class HeaderDiscovery(Thread):
+
+    # finds a device's baud rate and header from what it sends, in the background. the given baud rate is listened
+    # to for SAMPLE_SECONDS (a device may be slow to send, or print a boot banner first), then the common ones for
+    # PROBE_SECONDS each, dropped early once they yield garbage but no json object. readable text lines are not
+    # garbage. the first rate with a json object is kept and up to SAMPLE_LINES objects are read to infer the
+    # types. in binary mode the header comes from the one json object sent inside a cobs frame. discovery opens
+    # the port itself and closes it when done, Start opens it again for the capture (a port already being
+    # captured answers from its capture instead)
+    PROBE_SECONDS = 1.5
+    SAMPLE_SECONDS = 10
+    SAMPLE_LINES = 50
+    # garbage records / bytes without a json object before a common baud rate is given up
+    MAX_BAD = 8
+    MAX_BAD_BYTES = 4096
+
+    def __init__(self, port, baud=115200, protocol='json'):
+        super().__init__(daemon=True)
+        self.port = port
+        self.protocol = protocol
+        self.bauds = [baud] + [rate for rate in BAUD_RATES if rate != baud]
+        self.result = None
+        self._isRunning = True
+
+    def run(self):
+        try:
+            self.result = self._discover()
+        except (serial.SerialException, OSError) as e:
+            self.result = {'error': str(e)}
+
+    def _discover(self):
+        ser_obj = serial.Serial(port=self.port,
+                                baudrate=self.bauds[0],
+                                parity=serial.PARITY_NONE,
+                                stopbits=serial.STOPBITS_ONE,
+                                timeout=0.1)
+        try:
+            for i, baud in enumerate(self.bauds):
+                ser_obj.baudrate = baud
+                ser_obj.reset_input_buffer()
+                objects, framed = (self._sample(ser_obj, self.SAMPLE_SECONDS, drop=False) if i == 0
+                                   else self._sample(ser_obj, self.PROBE_SECONDS))
+                if not self._isRunning:
+                    return {'error': 'stopped'}
+                if objects:
+                    return {'baud': baud, 'header': infer_header(objects), 'lines': len(objects)}
+                if framed:
+                    return {'error': f'data frames but no header frame at {baud} baud, reset the device to resend it'}
+        finally:
+            ser_obj.close()
+        return {'error': f'no json received at {", ".join(map(str, self.bauds))} baud'}
+
+    def _sample(self, ser_obj, seconds, drop=True):
+        sep = b'\x00' if self.protocol == 'binary' else b'\n'
+        limit = 1 if self.protocol == 'binary' else self.SAMPLE_LINES
+        objects = []
+        buf = b''
+        bad = bad_bytes = 0
+        # binary data frames passing their crc show the baud rate is right even without a header frame
+        framed = False
+        deadline = time.monotonic() + seconds
+        while self._isRunning and time.monotonic() < deadline and len(objects) < limit:
+            chunk = ser_obj.read(max(1, ser_obj.in_waiting))
+            buf += chunk
+            # the first record is most likely cut off, it fails as json / crc then. in binary mode it may well be
+            # the header frame the device sends once when the port opens
+            *records, buf = buf.split(sep)
+            if len(buf) > SerialThread.MAX_LINE:
+                # no separator in sight, nothing that long is a line
+                buf = b''
+            for record in records:
+                obj = self._object(record)
+                if isinstance(obj, dict):
+                    objects.append(obj)
+                elif obj:
+                    framed = True
+                elif self._garbage(record):
+                    bad += 1
+                    bad_bytes += len(record) + 1
+            if drop and not objects and not framed:
+                if bad >= self.MAX_BAD or bad_bytes >= self.MAX_BAD_BYTES:
+                    return [], False
+                if len(buf) >= self.MAX_BAD_BYTES and self._garbage(buf):
+                    return [], False
+            if objects and seconds > self.PROBE_SECONDS:
+                # found, the rest of the sample should not take as long as finding it
+                deadline = min(deadline, time.monotonic() + self.PROBE_SECONDS)
+        return objects[:limit], framed
+
+    def _object(self, record):
+        # the json object in a record, True for a binary data frame, None for anything else
+        if self.protocol == 'binary':
+            try:
+                record = cobs_decode(record)
+            except ValueError:
+                return None
+            if len(record) > 2 and binascii.crc_hqx(record[:-2], 0xFFFF) == int.from_bytes(record[-2:], 'little'):
+                return True
+        try:
+            obj = fast_json.loads(record.strip())
+        except (ValueError, TypeError):
+            return None
+        return obj if isinstance(obj, dict) and obj else None
+
+    @staticmethod
+    def _garbage(record):
+        # bytes that are not readable text, what a wrong baud rate makes of a device's output
+        try:
+            text = record.decode()
+        except UnicodeDecodeError:
+            return True
+        return not all(c.isprintable() or c in '\r\n\t' for c in text)
+
+    def stop(self):
+        self._isRunning = False
+        self.join()
+
+
+class ClockFit:
+
+    # host seconds per device tick, guessed from the device time column suffix
+    UNITS = {'_ms': 1e-3, '_us': 1e-6, '_s': 1.0}
+
+    def __init__(self, column):
+        self.column = column
+        self.unit = next((unit for suffix, unit in self.UNITS.items() if column.endswith(suffix)), None)
+        self.lock = Lock()
+        self.residuals = RingBuffer(10000)
+        self._reset()
+
+    def _reset(self):
+        # running means and co-moments around the first sample, merged batch by batch
+        self.n = 0
+        self._x0 = None
+        self._y0 = None
+        self._last_x = None
+        self._mx = self._my = 0.0
+        self._cxx = self._cxy = self._cyy = 0.0
+
+    def update(self, device, host):
+        ok = ~(np.isnan(device) | np.isnan(host))
+        x = device[ok]
+        y = host[ok]
+        if len(x) == 0:
+            return
+        with self.lock:
+            if self._last_x is not None and x[0] < self._last_x:
+                # device clock went backwards (reset), start a new fit
+                self._reset()
+            if self._x0 is None:
+                self._x0, self._y0 = x[0], y[0]
+            self._last_x = x[-1]
+            x = x - self._x0
+            y = y - self._y0
+
+            nb = len(x)
+            mxb = x.mean()
+            myb = y.mean()
+            dx = x - mxb
+            dy = y - myb
+            n = self.n + nb
+            delta_x = mxb - self._mx
+            delta_y = myb - self._my
+            w = self.n * nb / n
+            self._cxx += dx @ dx + delta_x * delta_x * w
+            self._cxy += dx @ dy + delta_x * delta_y * w
+            self._cyy += dy @ dy + delta_y * delta_y * w
+            self._mx += delta_x * nb / n
+            self._my += delta_y * nb / n
+            self.n = n
+            if self._cxx > 0:
+                slope = self._cxy / self._cxx
+                self.residuals.extend(y - (self._my + slope * (x - self._mx)))
+
+    def summary(self):
+        with self.lock:
+            if self.n < 2 or self._cxx <= 0:
+                return None
+            slope = self._cxy / self._cxx
+            out = {
+                'n': self.n,
+                'slope': slope,
+                'jitter_ms': 1e3 * np.sqrt(max(self._cyy - self._cxy * slope, 0.0) / self.n),
+                # positive when the device clock runs fast
+                'drift_ppm': (self.unit / slope - 1) * 1e6 if self.unit else None,
+            }
+            # latency relative to the fastest line seen, the fixed part of the latency is not observable
+            res = self.residuals.window()
+            lag = 1e3 * (res - res.min())
+            out.update(zip(['lag_p50_ms', 'lag_p99_ms', 'lag_max_ms'], np.percentile(lag, [50, 99, 100])))
+            return out
+
+
+# integer columns hold this where a value is missing, it reads back as nan
+INT_MISSING = np.iinfo(np.int64).min
+
+
+def _int_column(values):
+    # exact int64 of an integer column, INT_MISSING where a value is missing
+    try:
+        return np.array(values, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):
+        return np.array([v if isinstance(v, int) else INT_MISSING for v in values], dtype=np.int64)
+
+
+def _int_values(arr):
+    # int64 with INT_MISSING -> itself, or float with nan when any value is missing
+    missing = arr == INT_MISSING
+    if missing.any():
+        arr = arr.astype(float)
+        arr[missing] = np.nan
+    return arr
+
+
+def _typed_array(values, fmt):
+    # integer columns stay int64 unless a value is missing, then they become float with nan like real columns
+    if fmt == 'integer':
+        try:
+            return np.array(values, dtype=np.int64)
+        except (TypeError, ValueError, OverflowError):
+            fmt = 'real'
+    return _column_array(values, fmt)
+
+
+def _missing_array(fmt, n):
+    if fmt == 'text':
+        return np.full(n, None, dtype=object)
+    return np.full(n, np.nan)
+
+
+class SqliteStore:
+
+    # one segment as an sqlite file, ROWID - 1 is the row within the segment
+    NAME = 'sqlite'
+    SUFFIX = '.db'
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    @staticmethod
+    def validate(data_header):
+        pass
+
+    def header(self):
+        if not Path(self.path).exists():
+            return []
+        conn = sqlite3.connect(self.path)
+        try:
+            return [(row[1], row[2].lower()) for row in conn.execute('PRAGMA table_info(my_data)')]
+        finally:
+            conn.close()
+
+    def n_rows(self):
+        if not Path(self.path).exists():
+            return 0
+        conn = sqlite3.connect(self.path)
+        try:
+            # rows are never deleted, so this is the row count without the full scan of COUNT()
+            return conn.execute('SELECT MAX(ROWID) FROM my_data').fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+
+    def size(self):
+        # committed pages sit in the -wal file until the next checkpoint
+        return sum(p.stat().st_size for p in [Path(self.path), Path(self.path + '-wal')] if p.exists())
+
+    def open(self, data_header):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS my_data ('
+            + ', '.join([f'"{hdr["name"]}" {hdr["fmt"]}' for hdr in data_header])
+            + ')'
+        )
+        # files captured before host stamps existed get the columns added
+        existing = [row[1] for row in conn.execute('PRAGMA table_info(my_data)')]
+        for hdr in HOST_HEADER:
+            if hdr['name'] not in existing:
+                conn.execute(f'ALTER TABLE my_data ADD COLUMN "{hdr["name"]}" {hdr["fmt"]}')
+        conn.commit()
+        self.conn = conn
+        self._insert = f'INSERT INTO my_data VALUES ({(",".join(["?"] * len(data_header)))})'
+
+    def append(self, rows, columns):
+        self.conn.executemany(self._insert, rows)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    def index(self, name):
+        # segments from before a channel was added don't have its column
+        if name not in dict(self.header()):
+            return
+        conn = self.conn or sqlite3.connect(self.path)
+        try:
+            create_index(conn, name)
+        finally:
+            if conn is not self.conn:
+                conn.close()
+
+    def indexed(self, name):
+        # True once lookups on name are index searches here, or there is no such column to index
+        if not Path(self.path).exists():
+            return True
+        conn = sqlite3.connect(self.path)
+        try:
+            if name not in [row[1] for row in conn.execute('PRAGMA table_info(my_data)')]:
+                return True
+            return f'my_data_{name}' in [row[1] for row in conn.execute('PRAGMA index_list(my_data)')]
+        finally:
+            conn.close()
+
+    def read(self, header, lo, hi, step=1, x=None, x0=None, x1=None, chunk=None):
+        # rows [lo, hi) of the segment as {'row': ..., name: array}, header is a list of (name, fmt)
+        cols = ''.join(f', "{name}"' for name, fmt in header)
+        where = ['ROWID > ?', 'ROWID <= ?']
+        params = [lo, hi]
+        if step > 1:
+            where.append('(ROWID - 1 - ?) % ? = 0')
+            params += [lo, step]
+        if x is not None and x0 is not None:
+            where.append(f'"{x}" >= ?')
+            params.append(x0)
+        if x is not None and x1 is not None:
+            where.append(f'"{x}" <= ?')
+            params.append(x1)
+        conn = sqlite3.connect(self.path)
+        try:
+            cur = conn.execute(f'SELECT ROWID - 1{cols} FROM my_data WHERE {" AND ".join(where)} ORDER BY ROWID',
+                               params)
+            while True:
+                rows = cur.fetchmany(chunk) if chunk else cur.fetchall()
+                if not rows:
+                    break
+                values = list(zip(*rows))
+                out = {'row': np.array(values[0], dtype=np.int64)}
+                for (name, fmt), col in zip(header, values[1:]):
+                    out[name] = _typed_array(col, fmt)
+                yield out
+                if not chunk:
+                    break
+        finally:
+            conn.close()
+
+    def locate(self, x, x0, x1, stop):
+        # first row with x >= x0 and last row with x <= x1 among rows [0, stop), index lookups on x
+        conn = sqlite3.connect(self.path)
+        try:
+            first = conn.execute(f'SELECT ROWID - 1 FROM my_data WHERE "{x}" >= ? AND ROWID <= ? '
+                                 f'ORDER BY "{x}" LIMIT 1', (x0, stop)).fetchone()
+            last = conn.execute(f'SELECT ROWID - 1 FROM my_data WHERE "{x}" <= ? AND ROWID <= ? '
+                                f'ORDER BY "{x}" DESC LIMIT 1', (x1, stop)).fetchone()
+        finally:
+            conn.close()
+        return None if first is None else first[0], None if last is None else last[0]
+
+
+class ColumnarStore:
+
+    # one segment as a directory holding an append-only file per channel in its header fmt's dtype,
+    # read back through numpy.memmap; header.json maps channel names to files
+    NAME = 'columnar'
+    SUFFIX = '.cols'
+    DTYPES = {'integer': np.dtype('<i8'), 'real': np.dtype('<f8')}
+
+    def __init__(self, path):
+        self.path = path
+        self._files = None
+
+    @classmethod
+    def validate(cls, data_header):
+        for hdr in data_header:
+            if hdr['fmt'] not in cls.DTYPES:
+                raise ValueError(f'columnar storage holds integer / real channels only, {hdr["name"]} is {hdr["fmt"]}')
+
+    def _columns(self):
+        try:
+            return json.loads((Path(self.path) / 'header.json').read_text())
+        except (OSError, ValueError):
+            return []
+
+    def _rows_in(self, col):
+        try:
+            return (Path(self.path) / col['file']).stat().st_size // self.DTYPES[col['fmt']].itemsize
+        except OSError:
+            return 0
+
+    def header(self):
+        return [(col['name'], col['fmt']) for col in self._columns()]
+
+    def n_rows(self, cols=None):
+        # every batch is appended to the files one after the other, rows present in all of them are complete
+        cols = self._columns() if cols is None else cols
+        return min((self._rows_in(col) for col in cols), default=0)
+
+    def size(self):
+        return sum(p.stat().st_size for p in Path(self.path).iterdir()) if Path(self.path).exists() else 0
+
+    def open(self, data_header):
+        self.validate(data_header)
+        path = Path(self.path)
+        path.mkdir(parents=True, exist_ok=True)
+        cols = self._columns()
+        n = self.n_rows(cols)
+        known = {col['name']: col for col in cols}
+        for hdr in data_header:
+            if hdr['name'] not in known:
+                # a channel new to this segment is padded with missing values for the rows before it
+                col = {'name': hdr['name'], 'fmt': hdr['fmt'], 'file': f'c{len(cols):04d}.bin'}
+                cols.append(col)
+                known[col['name']] = col
+                (np.full(n, INT_MISSING) if col['fmt'] == 'integer' else np.full(n, np.nan)).astype(
+                    self.DTYPES[col['fmt']]).tofile(path / col['file'])
+        tmp = path / 'header.json.tmp'
+        tmp.write_text(json.dumps(cols, indent=1))
+        tmp.replace(path / 'header.json')
+
+        self._files = []
+        for hdr in data_header:
+            col = known[hdr['name']]
+            f = open(path / col['file'], 'r+b')
+            # drop a batch that was cut short when the capture died
+            f.truncate(n * self.DTYPES[col['fmt']].itemsize)
+            f.seek(0, 2)
+            self._files.append((f, col['name'], col['fmt']))
+
+    def append(self, rows, columns):
+        values = None
+        for i, (f, name, fmt) in enumerate(self._files):
+            if fmt == 'real':
+                f.write(memoryview(np.ascontiguousarray(columns[name], dtype='<f8')))
+                continue
+            # integers from the rows, the float columns would round anything past 2**53
+            if values is None:
+                values = list(zip(*rows))
+            f.write(memoryview(_int_column(values[i])))
+
+    def commit(self):
+        for f, name, fmt in self._files:
+            f.flush()
+
+    def close(self):
+        for f, name, fmt in self._files:
+            f.close()
+        self._files = None
+
+    def index(self, name):
+        # time columns are increasing, locate() binary searches the file itself
+        pass
+
+    def indexed(self, name):
+        return True
+
+    def _map(self, col, n):
+        if n <= 0:
+            return np.empty(0, dtype=self.DTYPES[col['fmt']])
+        return np.memmap(Path(self.path) / col['file'], dtype=self.DTYPES[col['fmt']], mode='r', shape=(n,))
+
+    @staticmethod
+    def _values(arr, fmt):
+        return _int_values(arr) if fmt == 'integer' else arr
+
+    def read(self, header, lo, hi, step=1, x=None, x0=None, x1=None, chunk=None):
+        # slices of the memory maps, nothing is copied unless an x range or missing integers have to be masked
+        cols = {col['name']: col for col in self._columns()}
+        hi = min(hi, self.n_rows(cols.values()))
+        maps = {name: self._map(cols[name], hi) for name in {name for name, fmt in header} | ({x} - {None})}
+        span = hi - lo if not chunk else chunk * step
+        for a in range(lo, hi, max(span, 1)):
+            b = min(hi, a + span)
+            out = {'row': np.arange(a, b, step)}
+            for name, fmt in header:
+                out[name] = self._values(maps[name][a:b:step], fmt)
+            if x is not None and (x0 is not None or x1 is not None):
+                xs = self._values(maps[x][a:b:step], cols[x]['fmt'])
+                keep = np.ones(len(xs), dtype=bool)
+                if x0 is not None:
+                    keep &= xs >= x0
+                if x1 is not None:
+                    keep &= xs <= x1
+                out = {name: arr[keep] for name, arr in out.items()}
+            yield out
+
+    def locate(self, x, x0, x1, stop):
+        cols = {col['name']: col for col in self._columns()}
+        xs = self._map(cols[x], min(stop, self.n_rows(cols.values())))
+        first = int(np.searchsorted(xs, x0, 'left'))
+        last = int(np.searchsorted(xs, x1, 'right')) - 1
+        return None if first >= len(xs) else first, None if last < 0 else last
+
+
+def store_class(path):
+    # the storage format of a capture follows its file name: <name>.cols is columnar, anything else sqlite
+    return ColumnarStore if str(path).endswith(ColumnarStore.SUFFIX) else SqliteStore
+
+
+class Catalog:
+
+    # a capture is a chain of segments: the file the user picked, then <stem>.0001.db, <stem>.0002.db ...
+    # <file>.catalog lists them with their row range, host time range and per channel min / max
+    def __init__(self, path, entries, header):
+        self.path = path
+        self.lock = Lock()
+        self.header = header
+        self._entries = entries
+
+    @staticmethod
+    def entry(file, row0):
+        return {'file': file, 'row0': row0, 'rows': 0, 'time': None, 'min': {}, 'max': {}}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            entries = json.loads(Path(path + '.catalog').read_text())['segments']
+        except (OSError, ValueError, KeyError):
+            # single file captures from before segments existed
+            entries = [cls.entry(Path(path).name, 0)]
+        catalog = cls(path, entries, [])
+        catalog.header = catalog.store(entries[-1]).header()
+        # the open segment may have grown since the catalog was saved, its stats are unknown then
+        last = entries[-1]
+        rows = catalog.store(last).n_rows()
+        if rows != last['rows']:
+            last.update(rows=rows, time=None, min=None, max=None)
+        return catalog
+
+    def save(self):
+        with self.lock:
+            text = json.dumps({'segments': self._entries}, indent=1)
+        tmp = Path(self.path + '.catalog.tmp')
+        tmp.write_text(text)
+        tmp.replace(self.path + '.catalog')
+
+    @property
+    def n_rows(self):
+        with self.lock:
+            return self._entries[-1]['row0'] + self._entries[-1]['rows']
+
+    def entries(self):
+        with self.lock:
+            return [dict(entry) for entry in self._entries]
+
+    def segment_path(self, entry):
+        return str(Path(self.path).parent / entry['file'])
+
+    def store(self, entry):
+        return store_class(self.path)(self.segment_path(entry))
+
+    def add_rows(self, n):
+        with self.lock:
+            self._entries[-1]['rows'] += n
+
+    def add_stats(self, columns, names):
+        # merge the min / max of a batch into the open segment
+        with self.lock:
+            entry = self._entries[-1]
+            if entry['min'] is None:
+                return
+            for name in names:
+                mn = np.fmin.reduce(columns[name])
+                mx = np.fmax.reduce(columns[name])
+                if np.isnan(mn):
+                    continue
+                old = entry['min'].get(name)
+                entry['min'][name] = float(mn) if old is None else min(old, float(mn))
+                old = entry['max'].get(name)
+                entry['max'][name] = float(mx) if old is None else max(old, float(mx))
+            if 'host_time_s' in entry['min']:
+                entry['time'] = [entry['min']['host_time_s'], entry['max']['host_time_s']]
+
+    def rotate(self):
+        # close the open segment and start the next one, returns the new file's path
+        with self.lock:
+            last = self._entries[-1]
+            path = Path(self.path)
+            entry = self.entry(f'{path.stem}.{len(self._entries):04d}{path.suffix}', last['row0'] + last['rows'])
+            self._entries.append(entry)
+        self.save()
+        return self.segment_path(entry)
+
+    @staticmethod
+    def overlaps(entry, name, lo, hi):
+        # False only when the stats prove no row of the segment has lo <= name <= hi
+        mn = (entry['min'] or {}).get(name)
+        mx = (entry['max'] or {}).get(name)
+        if mn is None or mx is None:
+            return True
+        return (hi is None or mn <= hi) and (lo is None or mx >= lo)
+
+
+def read_columns(catalog, names, start=0, stop=None, step=1, x=None, x0=None, x1=None, chunk=None):
+    # rows [start, stop) of a capture, every step-th row, optionally only where x0 <= x <= x1; segments outside
+    # the range are never opened. yields {'index': ..., name: array} in row order, at most chunk rows each
+    fmts = dict(catalog.header)
+    for entry in catalog.entries():
+        row0 = entry['row0']
+        row1 = row0 + entry['rows']
+        if row1 <= start or (stop is not None and stop <= row0) or entry['rows'] == 0:
+            continue
+        if x is not None and not Catalog.overlaps(entry, x, x0, x1):
+            continue
+        store = catalog.store(entry)
+        have = dict(store.header())
+        if x is not None and x not in have:
+            continue
+        lo = max(start - row0, 0)
+        # keep the stride in step with start across segment boundaries
+        lo += (start - row0 - lo) % step
+        hi = (row1 if stop is None else min(stop, row1)) - row0
+        for cols in store.read([(name, have[name]) for name in names if name in have], lo, hi, step,
+                               x, x0, x1, chunk):
+            out = {'index': cols['row'] + row0}
+            for name in names:
+                # channels added after this segment was written
+                out[name] = cols[name] if name in cols else _missing_array(fmts.get(name), len(out['index']))
+            yield out
+
+
+class Capture:
+
+    # one device's pipeline behind the shared writer: parser, schema, ring buffer, decimator and segment files.
+    # batches are routed to it by key, the port its SerialThread reads
+    # roll over to a new segment file past either threshold
+    SEGMENT_BYTES = 256 << 20
+    SEGMENT_SECONDS = 6 * 3600
+
+    def __init__(self, filename, data_header, protocol='json', clock_column=None, key=None, derived=None):
+        self.key = key
+        self.filename = filename
+        self.device_header = [dict(hdr) for hdr in data_header]
+        # channels the device started sending during the capture, see evolve()
+        self.added = []
+        # derived channels are computed from each batch and stored after the host columns like any real channel
+        self.derived = []
+        names = [hdr['name'] for hdr in data_header + HOST_HEADER if hdr['fmt'] != 'text']
+        for hdr in derived or []:
+            self.derived.append((hdr['name'], compile_derived(hdr['expr'], names)))
+            names.append(hdr['name'])
+        self.data_header = data_header + HOST_HEADER + [{'name': name, 'fmt': 'real'} for name, _ in self.derived]
+        self.row_count = 0
+        self.pending = 0
+        self.parser = make_parser(data_header, protocol)
+        self.header = [(hdr['name'], hdr['fmt']) for hdr in self.data_header]
+        self.recent = RecentData(self.data_header)
+        self.clock = ClockFit(clock_column) if clock_column else None
+        self.decimator = Decimator([name for name, fmt in self.header if fmt != 'text'])
+        host = [hdr['name'] for hdr in HOST_HEADER]
+        self.stats = {name: RollingStats(max(STATS_WINDOWS)) for name, fmt in self.header
+                      if fmt != 'text' and name not in host}
+        store_class(filename).validate(self.data_header)
+        self.store = None
+        self.catalog = Catalog.load(filename)
+        # resuming a capture that grew channels keeps them
+        names = [name for name, fmt in self.catalog.header]
+        host = names.index('host_time_s') if 'host_time_s' in names else 0
+        self.evolve({name: fmt for name, fmt in self.catalog.header[:host] if name not in self.parser.names})
+        self.catalog.header = self.header
+        self.last_commit = time.monotonic()
+        self._indexes = []
+        self._new_indexes = []
+
+    def _open(self, path):
+        store = store_class(path)(path)
+        store.open(self.data_header)
+        for name in self._indexes:
+            store.index(name)
+        self._opened = time.monotonic()
+        return store
+
+    def _segment_full(self):
+        return (self.store.size() >= self.SEGMENT_BYTES
+                or time.monotonic() - self._opened >= self.SEGMENT_SECONDS)
+
+    def open(self):
+        self.store = self._open(self.catalog.segment_path(self.catalog.entries()[-1]))
+        self.catalog.save()
+        self.row_count = self.catalog.n_rows
+        if self.row_count:
+            # appending to an existing capture, the pyramid has to cover the old rows too
+            extend_decimator(self.decimator, self.header, self.catalog)
+            for chunk in read_columns(self.catalog, list(self.stats) + ['host_time_s'],
+                                      max(self.row_count - max(STATS_WINDOWS), 0)):
+                for name, stats in self.stats.items():
+                    stats.extend(chunk[name], chunk['host_time_s'])
+
+    def evolve(self, fmts):
+        # add channels (name -> fmt) after the device's other ones. rows from here on go to a new segment with the
+        # wider header, earlier segments read the new channels as missing. runs on the writer thread between
+        # batches, the reader keeps queueing meanwhile
+        added = []
+        for name, fmt in fmts.items():
+            hdr = {'pos': max([h['pos'] for h in self.device_header + self.added], default=-1) + 1,
+                   'name': name, 'fmt': fmt}
+            try:
+                check_channel_name(name, [col for col, _ in self.header] + [h['name'] for h in added])
+                store_class(self.filename).validate([hdr])
+            except ValueError as e:
+                self.parser.last_error = f'new key {name} not stored: {e}'
+                self.parser.ignore([name])
+                continue
+            self.added.append(hdr)
+            added.append(hdr)
+        if not added:
+            return
+        n_device = len(self.header) - len(HOST_HEADER) - len(self.derived)
+        self.data_header = self.data_header[:n_device] + added + self.data_header[n_device:]
+        self.header = [(hdr['name'], hdr['fmt']) for hdr in self.data_header]
+        self.parser.extend(added)
+        for hdr in added:
+            self.recent.add_channel(hdr['name'], hdr['fmt'])
+            if hdr['fmt'] != 'text':
+                self.decimator.add_channel(hdr['name'])
+                self.stats[hdr['name']] = RollingStats(max(STATS_WINDOWS))
+        self.catalog.header = self.header
+        if self.store is not None:
+            self.commit()
+            self._rotate()
+            METRICS.inc('schema_changes')
+
+    def add(self, lines, mono_ns, wall_ns):
+        t0 = time.perf_counter()
+        counts = self.parser.errors()
+        rows = self.parser.parse(lines)
+        new_keys = {name: fmt for name, fmt in self.parser.new_keys.items() if fmt is not None}
+        if new_keys:
+            # parsed again with the new channels so none of their values are lost
+            self.evolve(new_keys)
+            for name, count in counts.items():
+                setattr(self.parser, name, count)
+            rows = self.parser.parse(lines)
+        METRICS.observe('parse_seconds', time.perf_counter() - t0)
+        if not rows:
+            return
+        t0 = time.perf_counter()
+        stamp = (wall_ns / 1e9, mono_ns)
+        rows = [row + stamp for row in rows]
+        columns = rows_to_columns(rows, self.header[:len(self.header) - len(self.derived)],
+                                  self.row_count + self.pending)
+        if self.derived:
+            for name, evaluate in self.derived:
+                columns[name] = evaluate(columns)
+            extra = zip(*[columns[name].tolist() for name, _ in self.derived])
+            rows = [row + values for row, values in zip(rows, extra)]
+        self.store.append(rows, columns)
+        if self.clock is not None:
+            self.clock.update(columns[self.clock.column], columns['host_time_s'])
+        # the integer channels go to the ring buffers exact, their float columns round past 2**53
+        self.recent.extend(columns, {name: _int_column(list(map(itemgetter(i), rows)))
+                                     for i, (name, fmt) in enumerate(self.header) if fmt == 'integer'})
+        for name, stats in self.stats.items():
+            stats.extend(columns[name], columns['host_time_s'])
+        self.decimator.extend(columns, self.row_count + self.pending)
+        self.catalog.add_stats(columns, self.decimator.names)
+        self.pending += len(rows)
+        METRICS.observe('store_batch_seconds', time.perf_counter() - t0)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        self.store.commit()
+        METRICS.observe(f'{self.store.NAME}_commit_seconds', time.perf_counter() - t0)
+        METRICS.inc('rows_written', self.pending)
+        self.catalog.add_rows(self.pending)
+        self.row_count += self.pending
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        if self._segment_full():
+            self._rotate()
+            METRICS.inc('segments_rotated')
+
+    def _rotate(self):
+        # the finished segment's buckets are saved, reopening the capture doesn't scan it again
+        save_buckets(self.decimator, self.catalog, self.catalog.entries()[-1])
+        self.store.close()
+        self.store = self._open(self.catalog.rotate())
+
+    def add_indexes(self):
+        names, self._new_indexes = self._new_indexes, []
+        self._indexes += names
+        for name in names:
+            self.store.index(name)
+
+    def close(self):
+        self.commit()
+        self.store.close()
+        self.catalog.save()
+        save_buckets(self.decimator, self.catalog, self.catalog.entries()[-1])
+
+    def index(self, name):
+        # created on the open segment by the writer thread between commits, sqlite allows one writer at a time,
+        # and on every later segment as it is opened
+        if name not in self._indexes + self._new_indexes:
+            self._new_indexes.append(name)
+
+
+class StoreWriter(Thread):
+
+    # commit a capture when either threshold is reached, whichever comes first
+    COMMIT_ROWS = 5000
+    COMMIT_INTERVAL = 0.5
+
+    def __init__(self, captures, readers=()):
+        super().__init__(daemon=True)
+        self.captures = {capture.key: capture for capture in captures}
+        # stopped if the captures can't be written any more, rather than queueing lines nobody takes
+        self.readers = list(readers)
+        self.error = None
+        self._isRunning = True
+
+    @property
+    def row_count(self):
+        return sum(capture.row_count for capture in self.captures.values())
+
+    @property
+    def rows_received(self):
+        # including rows parsed into the ring buffers but not committed yet
+        return sum(capture.row_count + capture.pending for capture in self.captures.values())
+
+    def capture(self, path):
+        return next((capture for capture in self.captures.values() if capture.filename == path), None)
+
+    def run(self):
+        try:
+            self._write()
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            print(f'capture stopped: {self.error}')
+            METRICS.inc('writer_errors')
+            # a reader blocked on the full queue only sees the stop once its batch is taken
+            Q.abandon()
+            for reader in self.readers:
+                reader.stop()
+            PUSH.notify()
+
+    def _write(self):
+        for capture in self.captures.values():
+            capture.open()
+
+        # one thread writes every device, keep going after stop() until everything already queued is written
+        while self._isRunning or not Q.empty():
+            try:
+                lines, mono_ns, wall_ns, key = Q.get(timeout=self.COMMIT_INTERVAL)
+            except queue.Empty:
+                lines = []
+            if lines:
+                capture = self.captures.get(key)
+                if capture is None:
+                    # journaled by an earlier session capturing other ports
+                    METRICS.inc('queue_unrouted_lines', len(lines))
+                else:
+                    capture.add(lines, mono_ns, wall_ns)
+                    # readouts and plots read the ring buffers, they don't wait for the commit
+                    PUSH.notify()
+            now = time.monotonic()
+            due = [capture for capture in self.captures.values()
+                   if capture.pending and (capture.pending >= self.COMMIT_ROWS
+                                           or now - capture.last_commit >= self.COMMIT_INTERVAL)]
+            if due and Q.replaying():
+                # batches replayed from the journal are confirmed once every capture has committed its rows
+                due = [capture for capture in self.captures.values() if capture.pending]
+            for capture in due:
+                capture.commit()
+            for capture in self.captures.values():
+                if capture._new_indexes and not capture.pending:
+                    capture.add_indexes()
+            if not any(capture.pending for capture in self.captures.values()):
+                Q.confirm()
+
+        for capture in self.captures.values():
+            capture.close()
+        Q.confirm()
+
+    def stop(self):
+        self._isRunning = False
+        self.join()
+        return None
+
+
+class Pusher:
+
+    # wakes the /events streams when new rows reach the ring buffers. a stream sends at most one event per gap and
+    # rows arriving within the gap ride along with it; the gap is twice the server time the page's refresh
+    # callbacks took since the last event, so a fast device or a slow page stretches it instead of queueing refreshes
+    MIN_GAP = 0.05
+    MAX_GAP = 2.0
+    KEEPALIVE = 15
+
+    def __init__(self):
+        self.cond = Condition()
+        self.version = 0
+
+    def notify(self):
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+
+    def wait(self, version, timeout):
+        # the newest version, or version itself after timeout seconds without new rows
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def gap(self, busy):
+        return min(self.MAX_GAP, max(self.MIN_GAP, 2 * busy))
+
+    def stream(self, rows, busy=lambda: 0.0):
+        # rows() goes out with every event, busy() is the server time spent refreshing pages so far
+        seen = self.version
+        sent = 0.0
+        busy0 = busy()
+        while True:
+            version = self.wait(seen, self.KEEPALIVE)
+            if version == seen:
+                # lets the server notice closed pages
+                yield ': keepalive\n\n'
+                continue
+            while True:
+                wait = sent + self.gap(busy() - busy0) - time.monotonic()
+                if wait <= 0:
+                    break
+                # re-checked as the previous refresh finishes
+                time.sleep(min(wait, self.MIN_GAP))
+            seen = self.version
+            sent = time.monotonic()
+            busy0 = busy()
+            METRICS.inc('push_events')
+            yield f'data: {json.dumps({"rows": rows()})}\n\n'
+
+
+PUSH = Pusher()
+
+
+def _parser_errors(key):
+    if ENGINE.writer is None:
+        return None
+    return sum(capture.parser.errors()[key] for capture in ENGINE.writer.captures.values())
+
+
+METRICS.gauge('queue_batches', lambda: Q.qsize())
+METRICS.gauge('queue_lines', lambda: Q.lines)
+for _key in ['malformed', 'partial', 'mismatched']:
+    METRICS.gauge(f'parse_{_key}_lines', lambda key=_key: _parser_errors(key))
+METRICS.gauge('rows_committed', lambda: None if ENGINE.writer is None else ENGINE.writer.row_count)
+
+
+def buckets_path(catalog, entry):
+    return catalog.segment_path(entry) + '.buckets.npz'
+
+
+def save_buckets(decimator, catalog, entry):
+    # the pyramid's level 0 buckets as they stand after a segment's last row (the first one may hold rows of the
+    # segment before), so reopening the capture loads them instead of scanning the segment
+    if not entry['rows']:
+        return
+    first = entry['row0'] // Decimator.BUCKET
+    buckets = decimator.buckets(first, -(-(entry['row0'] + entry['rows']) // Decimator.BUCKET))
+    path = buckets_path(catalog, entry)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, names=np.array(buckets['names'], dtype=str), row0=entry['row0'], rows=entry['rows'],
+                     **{key: buckets[key] for key in ['min', 'max', 'sum', 'cnt']})
+        Path(path + '.tmp').replace(path)
+    except OSError:
+        pass
+
+
+def load_buckets(decimator, catalog, entry):
+    # True if the segment's saved buckets were loaded, they have to be for the rows the catalog lists
+    try:
+        with np.load(buckets_path(catalog, entry)) as f:
+            if int(f['row0']) != entry['row0'] or int(f['rows']) != entry['rows']:
+                return False
+            buckets = {key: f[key] for key in ['min', 'max', 'sum', 'cnt']}
+            buckets['names'] = f['names'].tolist()
+    except (OSError, ValueError, KeyError):
+        return False
+    decimator.load_buckets(entry['row0'] // Decimator.BUCKET, entry['row0'] + entry['rows'], buckets)
+    return True
+
+
+def extend_decimator(decimator, header, catalog, chunk=65536, closed=False):
+    # rows the decimator has not seen yet, segment by segment: saved buckets where they match, otherwise the rows
+    # are streamed (memory stays bounded by chunk) and the buckets saved for next time. the last segment may
+    # still grow unless the capture is closed
+    names = [name for name, fmt in header if fmt != 'text']
+    entries = catalog.entries()
+    for i, entry in enumerate(entries):
+        row1 = entry['row0'] + entry['rows']
+        if not entry['rows'] or row1 <= decimator.n_rows:
+            continue
+        if decimator.n_rows == entry['row0'] and load_buckets(decimator, catalog, entry):
+            continue
+        start = decimator.n_rows
+        for columns in read_columns(catalog, names, start=start, stop=row1, chunk=chunk):
+            decimator.extend(columns, start)
+            start += len(columns['index'])
+        if decimator.n_rows == row1 and (closed or i < len(entries) - 1):
+            save_buckets(decimator, catalog, entry)
+    return decimator
+
+
+def check_channel_name(name, names):
+    # a key the device starts sending mid-capture becomes a column name. sqlite compares those case-insensitively,
+    # and 'index' is the row number every read yields
+    if not name or '"' in name or not name.isprintable():
+        raise ValueError('channel names need printable characters other than "')
+    if name.lower() in [n.lower() for n in names] + ['index']:
+        raise ValueError('a channel of that name exists already')
+
+
+def create_index(conn, name):
+    t0 = time.perf_counter()
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "my_data_{name}" ON my_data ("{name}")')
+    conn.commit()
+    METRICS.observe('create_index_seconds', time.perf_counter() - t0)
+
+
+def device_tag(port):
+    # /dev/ttyUSB0 -> ttyUSB0, COM3 -> COM3
+    return re.sub(r'[^0-9A-Za-z]+', '', Path(port).name) or 'dev'
+
+
+def header_devices(hdr_data):
+    # ports in header order, header rows without a device belong to the only port
+    return list(dict.fromkeys(row.get('device') for row in hdr_data or [] if row))
+
+
+def device_filename(filename, device, devices):
+    # a single port writes to filename itself, several ports each get <stem>_<port><suffix> next to it
+    if len(devices) < 2:
+        return filename
+    path = Path(filename)
+    return str(path.with_name(f'{path.stem}_{device_tag(device)}{path.suffix}'))
+
+
+def resolve_channel(filename, hdr_data, value):
+    # (capture file, column) behind a dropdown value, (None, value) if its port is not in the header
+    devices = header_devices(hdr_data)
+    if len(devices) < 2:
+        return filename, value
+    tag, _, name = value.partition(':')
+    device = next((device for device in devices if device_tag(device) == tag), None)
+    if device is None or not name:
+        return None, value
+    return device_filename(filename, device, devices), name
+
+
+def parse_derived(text, hdr_data):
+    # 'name = expression' per line -> header rows for the derived channels, each on the port whose channels it uses
+    devices = header_devices(hdr_data)
+    host = [hdr['name'] for hdr in HOST_HEADER]
+    names = {device: [row['name'] for row in hdr_data if row.get('device') == device and row.get('fmt') != 'text']
+             + host for device in devices}
+    taken = {device: {row['name'] for row in hdr_data if row.get('device') == device} | set(host)
+             for device in devices}
+    last = {device: max([row['pos'] for row in hdr_data if row.get('device') == device], default=-1)
+            for device in devices}
+    rows = []
+    for line in (text or '').splitlines():
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        name, sep, expr = line.partition('=')
+        name = name.strip()
+        if not sep or not name.isidentifier():
+            raise ValueError(f'{line!r}: expected name = expression')
+        found, error = [], None
+        for device in devices:
+            try:
+                compile_derived(expr, names[device])
+            except ValueError as e:
+                error = error or e
+                continue
+            found.append(device)
+            break
+        if not found:
+            # a derived channel can't mix devices, their rows are not sampled together
+            raise error or ValueError(f'{name}: initialize the headers first')
+        device = found[0]
+        if name in taken[device]:
+            raise ValueError(f'{name} is already a channel')
+        names[device].append(name)
+        taken[device].add(name)
+        last[device] += 1
+        rows.append({'device': device, 'pos': last[device], 'name': name, 'fmt': 'real', 'expr': expr.strip()})
+    return rows
+
+
+def _json_column(values):
+    # nan as null, json has no nan
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values)
+        if missing.any():
+            values = values.astype(object)
+            values[missing] = None
+    return values.tolist()
+
+
+def _json_value(value):
+    # numpy scalars and nan as json
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+class Engine:
+
+    # one capture session: a reader per port and the writer behind them. the web app drives it in process,
+    # or through the control api when it runs on its own
+    def __init__(self):
+        self.lock = Lock()
+        self.writer = None
+        self.readers = {}
+        self.discoveries = {}
+
+    @property
+    def running(self):
+        return self.writer is not None and self.writer.is_alive()
+
+    @property
+    def rows_received(self):
+        return None if self.writer is None else self.writer.rows_received
+
+    def ports(self):
+        return [{'device': port.device, 'description': port.description}
+                for port in serial.tools.list_ports.comports()]
+
+    def discover(self, ports, baud=115200, protocol='json'):
+        # start finding the baud rate and header of each port, poll discovery() for the results. a port that is
+        # being captured answers from its capture, without opening it again
+        ports = [ports] if isinstance(ports, str) else list(ports)
+        with self.lock:
+            for port in ports:
+                old = self.discoveries.pop(port, None)
+                if old is not None and old.is_alive():
+                    old.stop()
+                discovery = self.discoveries[port] = HeaderDiscovery(port, baud, protocol)
+                capture = self.writer.captures.get(port) if self.running else None
+                if capture is not None:
+                    discovery.result = {'baud': self.readers[port].ser_obj.baudrate,
+                                        'header': capture.device_header + capture.added, 'lines': None}
+                else:
+                    discovery.start()
+
+    def discovery(self, ports=None):
+        # {'done': all finished, 'results': {port: {'baud', 'header', 'lines'} or {'error'}, None while running}}
+        with self.lock:
+            discoveries = {port: d for port, d in self.discoveries.items() if ports is None or port in ports}
+        results = {port: discovery.result for port, discovery in discoveries.items()}
+        return {'done': all(result is not None for result in results.values()), 'results': results}
+
+    def start(self, filename, data_header, ports, baud=115200, protocol='json', overflow='block', clock_column=None,
+              derived=None):
+        # one capture per port, all written by the same writer thread. header and derived rows carry the port
+        # they belong to in 'device', rows without one belong to the first port
+        with self.lock:
+            if self.running:
+                raise ValueError('already capturing')
+            ports = [ports] if isinstance(ports, str) else list(ports)
+            for port in ports:
+                discovery = self.discoveries.get(port)
+                if discovery is not None and discovery.is_alive():
+                    discovery.stop()
+            devices = list(dict.fromkeys(ports))
+            # rows of ports that were discovered and then deselected are not captured
+            data_header = [row for row in data_header if (row.get('device') or ports[0]) in devices]
+            derived = [row for row in derived or [] if (row.get('device') or ports[0]) in devices]
+            clock_file, clock_name = (resolve_channel(filename, data_header, clock_column) if clock_column
+                                      else (None, None))
+            readers = {}
+            try:
+                Q.configure(policy=overflow, spill_path=filename + '.spill')
+                captures = []
+                for device in devices:
+                    device_file = device_filename(filename, device, devices)
+                    rows = [{key: row[key] for key in ['pos', 'name', 'fmt']} for row in data_header
+                            if (row.get('device') or ports[0]) == device]
+                    captures.append(Capture(device_file, rows, protocol=protocol,
+                                            clock_column=clock_name if clock_file == device_file else None,
+                                            key=device,
+                                            derived=[row for row in derived or []
+                                                     if (row.get('device') or ports[0]) == device]))
+                for device in devices:
+                    readers[device] = SerialThread(device, baud=baud, protocol=protocol)
+                writer = StoreWriter(captures, readers.values())
+            except (ValueError, serial.SerialException) as e:
+                for reader in readers.values():
+                    reader.ser_obj.close()
+                raise ValueError(str(e))
+            self.writer = writer
+            self.readers = readers
+            self.writer.start()
+            for reader in self.readers.values():
+                reader.start()
+
+    def stop(self):
+        with self.lock:
+            running = self.running
+            if not running and not self.readers:
+                return
+            # reader first so every line it read is queued, then the writer drains the queue and the journal.
+            # after a writer failure only the readers are left to close
+            for reader in self.readers.values():
+                reader.stop()
+            if running:
+                self.writer.stop()
+            self.readers = {}
+        # lets the event streams see the end of the capture
+        PUSH.notify()
+
+    def capture(self, path):
+        # the capture of the current (or last) session writing path, None if there is none
+        return None if self.writer is None else self.writer.capture(path)
+
+    def index(self, path, name):
+        # has the writer index name on the open segment of path, False if path is not being captured
+        with self.lock:
+            capture = self.capture(path) if self.running else None
+            if capture is not None:
+                capture.index(name)
+            return capture is not None
+
+    def live(self, path, name, window):
+        # newest value and rolling statistics of a channel while path is captured
+        capture = self.capture(path)
+        if capture is None or name not in capture.recent.rings:
+            return None
+        stats = capture.stats.get(name)
+        return {'last': _json_value(capture.recent.last(name)),
+                'stats': None if stats is None else stats.summary(window)}
+
+    def row_events(self, path, names=None, start=None):
+        # server-sent events with the rows of a running capture, from row start on or from the next row. every
+        # stream keeps its own cursor into the capture's ring buffers, so any number of clients get every row the
+        # writer parsed without extra parsing or store reads. rows overwritten before a slow client got them are
+        # announced as a gap event, the capture file still has them
+        capture = self.capture(path)
+        if capture is None or not self.running:
+            raise ValueError(f'{path} is not being captured')
+        names = list(names or [name for name, fmt in capture.recent.header])
+        unknown = [name for name in names if name not in capture.recent.rings]
+        if unknown:
+            raise ValueError(f'no channel {", ".join(unknown)} in {path}')
+        return self._row_events(capture, names, capture.recent.next_row() if start is None else int(start))
+
+    def _row_events(self, capture, names, cursor):
+        wake = PUSH.stream(lambda: None)
+        while True:
+            ended = not self.running
+            first, columns = capture.recent.read(cursor, names)
+            if first > cursor:
+                yield f'event: gap\ndata: {json.dumps({"from": cursor, "to": first})}\n\n'
+            n = len(next(iter(columns.values()))) if columns else 0
+            if n:
+                data = {'first': first, 'columns': {name: _json_column(col) for name, col in columns.items()}}
+                yield f'data: {json.dumps(data)}\n\n'
+            cursor = first + n
+            if ended:
+                yield 'event: end\ndata: {}\n\n'
+                return
+            event = next(wake)
+            if event.startswith(':'):
+                yield event
+
+    def status(self):
+        if self.writer is None:
+            return None
+        captures = []
+        for capture in self.writer.captures.values():
+            clock = None
+            if capture.clock is not None:
+                clock = {'column': capture.clock.column, 'fit': capture.clock.summary()}
+            captures.append({'key': capture.key, 'filename': capture.filename, 'rows': capture.row_count,
+                             'errors': capture.parser.errors(), 'last_error': capture.parser.last_error,
+                             'clock': clock, 'added': capture.added})
+        return {'running': self.running, 'rows_received': self.writer.rows_received,
+                'rows_committed': self.writer.row_count, 'error': self.writer.error, 'captures': captures}
+
+
+ENGINE = Engine()
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+
+    # control api for an engine running on its own, json in and out:
+    #   GET  /status /ports /discovery?ports=a,b /live?file=&name=&window= /metrics /metrics.json /events
+    #        /rows?file=&names=&from= (Engine.row_events)
+    #   POST /discover /start (Engine.discover / Engine.start arguments) /stop /index (path, name)
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, body, status=200, mimetype='application/json'):
+        data = (body if isinstance(body, str) else json.dumps(body)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', mimetype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, events):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+        for event in events:
+            self.wfile.write(event.encode())
+            self.wfile.flush()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/status':
+                self._send(ENGINE.status())
+            elif url.path == '/ports':
+                self._send(ENGINE.ports())
+            elif url.path == '/discovery':
+                self._send(ENGINE.discovery([port for port in args.get('ports', '').split(',') if port] or None))
+            elif url.path == '/live':
+                self._send(ENGINE.live(args['file'], args['name'], int(args.get('window', STATS_WINDOWS[1]))))
+            elif url.path == '/metrics':
+                self._send(METRICS.text(), mimetype='text/plain')
+            elif url.path == '/metrics.json':
+                self._send(METRICS.snapshot())
+            elif url.path == '/events':
+                self._stream(PUSH.stream(lambda: ENGINE.rows_received))
+            elif url.path == '/rows':
+                names = [name for name in args.get('names', '').split(',') if name]
+                self._stream(ENGINE.row_events(args['file'], names, args.get('from')))
+            else:
+                self._send({'error': f'no such endpoint {url.path}'}, 404)
+        except (KeyError, ValueError, serial.SerialException) as e:
+            self._send({'error': str(e)}, 400)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            if url.path == '/discover':
+                ENGINE.discover(**body)
+                self._send(ENGINE.discovery(body.get('ports')))
+            elif url.path == '/start':
+                ENGINE.start(**body)
+                self._send(ENGINE.status())
+            elif url.path == '/stop':
+                ENGINE.stop()
+                self._send(ENGINE.status())
+            elif url.path == '/index':
+                self._send({'queued': ENGINE.index(**body)})
+            else:
+                self._send({'error': f'no such endpoint {url.path}'}, 404)
+        except (TypeError, ValueError) as e:
+            self._send({'error': str(e)}, 400)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_api(address):
+    host, _, port = address.rpartition(':')
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), ApiHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', action='append', default=[],
+                        help='serial port to capture, repeat for several devices')
+    parser.add_argument('--baud', type=int, default=115200,
+                        help='tried first when the header is read from the devices, then the common rates')
+    parser.add_argument('--protocol', choices=['json', 'binary'], default='json')
+    parser.add_argument('--file', help='capture file, .db for sqlite or .cols for columnar '
+                                       '(default data/my_data_<date>.db)')
+    parser.add_argument('--header', help='json file with the header rows [{"pos", "name", "fmt"}, ...], '
+                                         'found from what the devices send when omitted')
+    parser.add_argument('--overflow', choices=CaptureQueue.POLICIES, default='block')
+    parser.add_argument('--clock', help='device time column for clock alignment')
+    parser.add_argument('--derived', action='append', default=[], help="derived channel 'name = expression'")
+    parser.add_argument('--api', metavar='HOST:PORT', help='serve the control api the web app attaches to')
+    parser.add_argument('--status-every', type=float, default=10, help='seconds between status lines, 0 = quiet')
+    args = parser.parse_args()
+    if not args.port and not args.api:
+        parser.error('nothing to do, give --port to capture and / or --api to be controlled')
+
+    stop = Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    server = serve_api(args.api) if args.api else None
+    try:
+        if args.port:
+            if args.header:
+                header = json.loads(Path(args.header).read_text())
+            else:
+                # baud rate and header found from what the devices send
+                ENGINE.discover(args.port, args.baud, args.protocol)
+                while not ENGINE.discovery(args.port)['done']:
+                    if stop.wait(0.2):
+                        return
+                results = ENGINE.discovery(args.port)['results']
+                errors = [f'{port}: {result["error"]}' for port, result in results.items() if 'error' in result]
+                if errors:
+                    raise ValueError('; '.join(errors))
+                bauds = {result['baud'] for result in results.values()}
+                if len(bauds) > 1:
+                    raise ValueError(f'the ports send at different baud rates ({", ".join(map(str, bauds))})')
+                args.baud = bauds.pop()
+                header = [dict(row, device=port) for port, result in results.items() for row in result['header']]
+                print(f'found {len(header)} channels at {args.baud} baud', flush=True)
+            filename = args.file or f'data/my_data_{datetime.now().strftime("%m.%d.%Y.%H.%M.%S")}.db'
+            ENGINE.start(filename, header, args.port, baud=args.baud, protocol=args.protocol,
+                         overflow=args.overflow, clock_column=args.clock,
+                         derived=parse_derived('\n'.join(args.derived), header))
+            print(f'capturing {", ".join(args.port)} into {filename}', flush=True)
+        if server is not None:
+            print(f'control api on http://{args.api}', flush=True)
+        while not stop.wait(args.status_every or None):
+            status = ENGINE.status()
+            if status is not None:
+                print(f'{status["rows_committed"]} rows written, '
+                      f'{sum(c["errors"]["lines"] for c in status["captures"])} lines read', flush=True)
+    except (ValueError, serial.SerialException) as e:
+        parser.exit(1, f'could not start: {e}\n')
+    finally:
+        ENGINE.stop()
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 import dash
@@ -7,57 +8,504 @@ import dash_html_components as html
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import dash_table
+from flask import Response, jsonify, request, stream_with_context
 
 import plotly.graph_objs as go
 
-from threading import Thread
-import queue
-import serial
-import serial.tools.list_ports
+from threading import Thread, Lock
+import csv
+import io
+import argparse
 
 import time
+
 from pathlib import Path
 import json
-import sqlite3
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from urllib.error import URLError, HTTPError
+
+# parquet export is offered when pyarrow is installed
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# reading, parsing and writing captures lives in capture_engine, which also runs on its own without the ui
+from capture_engine import (METRICS, PUSH, ENGINE, HOST_HEADER, STATS_WINDOWS, BAUD_RATES, RollingStats, Decimator,
+                            Catalog,
+                            read_columns, SqliteStore, ColumnarStore, extend_decimator, device_tag, header_devices,
+                            device_filename, resolve_channel, parse_derived)
 
 # globals... yuk
 FILE_DIR = ''
 APP_ID = 'serial_data'
-Q = queue.Queue()
-SERIAL_THREAD = None
-
-class SerialThread(Thread):
-
-    def __init__(self, port, baud=115200):
-        super().__init__()
-        self.port = port
-        self._isRunning = True
-        self.ser_obj = serial.Serial(port=port,
-                                     baudrate=baud,
-                                     parity=serial.PARITY_NONE,
-                                     stopbits=serial.STOPBITS_ONE,
-                                     timeout=None)
-
-    def run(self):
-        while self._isRunning:
+PLOT_POINTS = 2000
+# rows appended to a live plot through extendData before it is redrawn from a fresh snapshot
+PLOT_EXTEND_POINTS = 2000
+# a zoomed window is drawn from raw rows when it holds at most this many, from the min/max envelope otherwise
+PLOT_WINDOW_POINTS = 5000
+# ms between refreshes when the browser can't hold an /events stream open, and as a fallback when it can
+POLL_INTERVAL = 2000
+PUSH_FALLBACK_INTERVAL = 10000
+# ms between looks at a running header discovery
+DISCOVERY_INTERVAL = 500
+
+# callbacks that run on every refresh, their time paces the pushed events
+REFRESH_CALLBACKS = [f'{APP_ID}_update_store_seconds', f'{APP_ID}_update_readouts_seconds',
+                     f'{APP_ID}_update_figures_seconds']
+
+
+class RemoteEngine:
+
+    # the calls of capture_engine.Engine answered by a capture daemon's control api (capture_engine.py --api).
+    # the daemon owns the captures, figures and readouts read its files, so both have to see the same FILE_DIR
+    TIMEOUT = 10
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.rows_received = None
+        Thread(target=self._follow, daemon=True).start()
+
+    def _open(self, path, body=None, timeout=TIMEOUT, **args):
+        url = self.url + path + (f'?{urlencode(args)}' if args else '')
+        data = None if body is None else json.dumps(body).encode()
+        try:
+            return urlopen(Request(url, data=data, headers={'Content-Type': 'application/json'}), timeout=timeout)
+        except HTTPError as e:
+            raise ValueError(json.loads(e.read()).get('error', str(e)))
+        except URLError as e:
+            raise ValueError(f'capture daemon at {self.url}: {e.reason}')
+
+    def _call(self, path, body=None, **args):
+        with self._open(path, body, **args) as response:
+            return json.loads(response.read())
+
+    def _relay(self, response):
+        with response:
+            for line in response:
+                yield line.decode()
+
+    def _follow(self):
+        # relays the daemon's events to this app's pages, reconnecting while the daemon restarts
+        while True:
             try:
-                while self.ser_obj.in_waiting > 2:
-                    try:
-                        line = self.ser_obj.readline()
-                        split_line = line.strip().decode("utf-8")
-                        Q.put(split_line)
-                    except:
-                        continue
-            except:
-                continue
+                with urlopen(f'{self.url}/events', timeout=2 * PUSH.KEEPALIVE) as response:
+                    for line in response:
+                        if line.startswith(b'data:'):
+                            self.rows_received = json.loads(line[5:])['rows']
+                            PUSH.notify()
+            except (OSError, ValueError):
+                pass
+            time.sleep(1)
+
+    @property
+    def running(self):
+        status = self._call('/status')
+        return status is not None and status['running']
+
+    def ports(self):
+        return self._call('/ports')
 
+    def discover(self, ports, baud=115200, protocol='json'):
+        self._call('/discover', dict(ports=ports, baud=baud, protocol=protocol))
+
+    def discovery(self, ports=None):
+        return self._call('/discovery', ports=','.join(ports or []))
+
+    def start(self, filename, data_header, ports, **kwargs):
+        self._call('/start', dict(kwargs, filename=filename, data_header=data_header, ports=ports))
 
     def stop(self):
-        self._isRunning = False
-        time.sleep(0.25)
-        self.ser_obj.close()
+        self._call('/stop', {})
+
+    def capture(self, path):
+        return None
+
+    def index(self, path, name):
+        return self._call('/index', dict(path=path, name=name))['queued']
+
+    def live(self, path, name, window):
+        return self._call('/live', file=path, name=name, window=window)
+
+    def row_events(self, path, names=None, start=None):
+        args = {'file': path, 'names': ','.join(names or [])}
+        if start is not None:
+            args['from'] = start
+        return self._relay(self._open('/rows', timeout=2 * PUSH.KEEPALIVE, **args))
+
+    def status(self):
+        return self._call('/status')
+
+
+def data_path(filename):
+    # FILE_DIR + filename for a file inside the data directory, requests naming anything outside it
+    # (absolute paths, .., symlinks out) are refused
+    root = Path(FILE_DIR or '.').resolve()
+    if root not in (root / filename).resolve().parents:
+        raise ValueError(f'{filename} is not a capture file')
+    return FILE_DIR + filename
+
+
+def live_capture(filename):
+    # the capture the engine is appending to filename, None if that file is not being captured in this process
+    if filename is None:
         return None
+    return ENGINE.capture(FILE_DIR + filename)
+
+
+def capture_catalog(filename):
+    # the live writer's catalog is current to the last commit, other captures are read from disk
+    capture = live_capture(filename)
+    if capture is not None:
+        return capture.catalog
+    return Catalog.load(FILE_DIR + filename)
+
+
+def ensure_index(filename, name):
+    # index the x column a figure is zoomed on so window lookups are a b-tree search instead of a scan. each
+    # segment is asked whether it has the index, whichever process created it
+    path = FILE_DIR + filename
+    if name == 'index':
+        return True
+    catalog = capture_catalog(filename)
+    if name not in [col for col, fmt in catalog.header]:
+        return False
+    entries = catalog.entries()
+    missing = [entry for entry in entries if not catalog.store(entry).indexed(name)]
+    if not missing:
+        return True
+    try:
+        # the open segment belongs to the writer, in this process or in the capture daemon
+        queued = ENGINE.index(path, name)
+    except ValueError:
+        return False
+    for entry in missing:
+        if not (queued and entry['file'] == entries[-1]['file']):
+            catalog.store(entry).index(name)
+    return True
+
+
+_HISTORY = OrderedDict()
+# one decimator per device of a multi port capture
+HISTORY_FILES = 8
+
+
+def history_decimator(filename, catalog):
+    # decimator for a capture file that is not being written by this process, updated if the file grew
+    path = FILE_DIR + filename
+    decimator = _HISTORY.get(path)
+    if decimator is None or decimator.n_rows > catalog.n_rows:
+        decimator = Decimator([name for name, fmt in catalog.header if fmt != 'text'])
+    extend_decimator(decimator, catalog.header, catalog)
+    _HISTORY.pop(path, None)
+    _HISTORY[path] = decimator
+    while len(_HISTORY) > HISTORY_FILES:
+        _HISTORY.popitem(last=False)
+    return decimator
+
+
+class Snapshot:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        capture = live_capture(filename)
+        self.recent = None if capture is None else capture.recent
+        self.live_stats = {} if capture is None else capture.stats
+        self._stats = {}
+        self.catalog = capture_catalog(filename)
+        self.decimator = capture.decimator if capture is not None else history_decimator(filename, self.catalog)
+        # freeze the row count so every view of this tick shows the same rows
+        self.n_rows = self.decimator.n_rows
+        self._last = None
+        self._raw = None
+        self._x = {}
+        self._y = {}
+
+    def _raw_rows(self):
+        if self._raw is None:
+            if self.n_rows <= PLOT_POINTS and self.recent is not None and self.recent.covers():
+                self._raw = self.recent.columns(['index'] + [name for name, fmt in self.recent.header],
+                                                n=self.n_rows)
+            else:
+                self._raw = self._read([name for name, fmt in self.catalog.header], 0, self.n_rows,
+                                       self.n_rows // PLOT_POINTS + 1)
+        return self._raw
+
+    def _read(self, names, start, stop, step=1):
+        chunks = list(read_columns(self.catalog, names, start, stop, step))
+        if len(chunks) == 1:
+            return pd.DataFrame(chunks[0])
+        return pd.DataFrame({name: np.concatenate([c[name] for c in chunks]) if chunks else []
+                             for name in ['index'] + list(names)})
+
+    def _locate(self, x_name, x0, x1):
+        # first and last row inside the window, two index lookups; x is expected to be increasing
+        # (device or host time), for other columns the rows in between may stray outside the window
+        entries = [entry for entry in self.catalog.entries()
+                   if entry['row0'] < self.n_rows and entry['rows'] and Catalog.overlaps(entry, x_name, x0, x1)]
+        first = last = None
+        for entry in entries:
+            first = self.catalog.store(entry).locate(x_name, x0, x1, self.n_rows - entry['row0'])[0]
+            if first is not None:
+                first += entry['row0']
+                break
+        for entry in reversed(entries):
+            last = self.catalog.store(entry).locate(x_name, x0, x1, self.n_rows - entry['row0'])[1]
+            if last is not None:
+                last += entry['row0']
+                break
+        if first is None or last is None:
+            return 0, -1
+        return first, last
+
+    def columns(self, x_name, y_names):
+        with self.lock:
+            names = [x_name] + list(y_names)
+            if self.n_rows <= PLOT_POINTS or any(n != 'index' and n not in self.decimator.names for n in names):
+                # small captures and text channels are plotted from raw rows
+                raw = self._raw_rows()
+                return raw[x_name], {name: raw[name] for name in y_names}
+
+            missing = [name for name in y_names if name not in self._y]
+            if missing or x_name not in self._x:
+                x, ys = self.decimator.fetch(x_name, missing, stop=self.n_rows, max_points=PLOT_POINTS)
+                self._x[x_name] = x
+                self._y.update(ys)
+            return self._x[x_name], {name: self._y[name] for name in y_names}
+
+    def window(self, x_name, y_names, x0, x1):
+        # rows whose x lies in [x0, x1], at full resolution when they fit in PLOT_WINDOW_POINTS
+        if x_name == 'index':
+            first, last = max(int(np.ceil(x0)), 0), min(int(np.floor(x1)), self.n_rows - 1)
+        else:
+            first, last = self._locate(x_name, x0, x1)
+        n = last - first + 1
+        names = [x_name] + list(y_names)
+        if n <= 0:
+            return np.array([]), {name: np.array([]) for name in y_names}
+
+        if n > PLOT_WINDOW_POINTS and all(name == 'index' or name in self.decimator.names for name in names):
+            return self.decimator.fetch(x_name, y_names, start=first, stop=last + 1, max_points=PLOT_POINTS)
+
+        raw = self._read([name for name in dict.fromkeys(names) if name != 'index'], first, last + 1,
+                         -(-n // PLOT_WINDOW_POINTS))
+        return raw[x_name], {name: raw[name] for name in y_names}
+
+    def since(self, start, names):
+        # raw rows appended after row start, only available for the live capture
+        if self.recent is None:
+            return None
+        return self.recent.since(start, self.n_rows, names)
+
+    def last(self, name):
+        with self.lock:
+            if self._last is None:
+                if self.recent is not None:
+                    self._last = self.recent.columns(self.recent.rings.keys(), n=1)
+                else:
+                    # not the live capture, only the newest row is needed
+                    self._last = self._read([name for name, fmt in self.catalog.header],
+                                            max(self.n_rows - 1, 0), self.n_rows)
+            col = self._last[name]
+            return col[0] if len(col) else None
+
+    def stats(self, name, window):
+        # rolling statistics kept by the live capture, other files get them from their newest rows once
+        if name in self.live_stats:
+            return self.live_stats[name].summary(window)
+        with self.lock:
+            if (name, window) not in self._stats:
+                header = dict(self.catalog.header)
+                if header.get(name, 'text') == 'text':
+                    return None
+                # captures from before the host columns have no receive time, rates stay empty
+                times = ['host_time_s'] if 'host_time_s' in header else []
+                rows = self._read([name] + times, max(self.n_rows - window, 0), self.n_rows)
+                stats = self._stats[(name, window)] = RollingStats(window)
+                stats.extend(rows[name].to_numpy(dtype=float),
+                             rows['host_time_s'].to_numpy(dtype=float) if times else np.full(len(rows), np.nan))
+        return self._stats[(name, window)].summary(window)
+
+
+class SnapshotCache:
+
+    # a few store updates for each device's file
+    SIZE = 16
+
+    def __init__(self):
+        self.lock = Lock()
+        self._snapshots = OrderedDict()
+
+    def get(self, filename, key):
+        # one snapshot per (file, store update), shared by every callback fired by that update in every open page
+        with self.lock:
+            snapshot = self._snapshots.get((filename, key))
+            if snapshot is None:
+                snapshot = Snapshot(filename)
+                self._snapshots[(filename, key)] = snapshot
+                while len(self._snapshots) > self.SIZE:
+                    self._snapshots.popitem(last=False)
+            return snapshot
+
+
+SNAPSHOTS = SnapshotCache()
+
+
+def snapshot_key(ts, rows_seen):
+    # pages refreshed by the same push carry the same row count, their callbacks share one snapshot. the store's
+    # timestamp is per page and only keys updates without a running capture
+    return ('ts', ts) if rows_seen is None else ('rows', rows_seen)
+
+
+EXPORT_CHUNK = 20000
+
+
+def export_rows(catalog, columns=None, start=None, stop=None, x=None, x0=None, x1=None, chunk=EXPORT_CHUNK):
+    # yields the (name, fmt) header once, then dicts of numpy columns (index included) of at most chunk rows;
+    # memory is bounded by chunk
+    table = catalog.header
+    known = dict(table)
+    if columns:
+        unknown = [c for c in columns if c not in known]
+        if unknown:
+            raise ValueError(f'unknown columns: {", ".join(unknown)}')
+        table = [(c, known[c]) for c in columns]
+    if x == 'index':
+        x = None
+    if x is not None and x not in known:
+        raise ValueError(f'unknown column: {x}')
+    start, stop = 0 if start is None else int(start), None if stop is None else int(stop)
+    x0, x1 = None if x0 is None else float(x0), None if x1 is None else float(x1)
+    yield [('index', 'integer')] + table
+    yield from read_columns(catalog, [name for name, fmt in table], start, stop, x=x, x0=x0, x1=x1, chunk=chunk)
+
+
+def _csv_values(arr, fmt):
+    # missing values are written as empty fields, integers with gaps in them without a trailing .0
+    if arr.dtype.kind == 'f' and (fmt == 'integer' or np.isnan(arr).any()):
+        return [None if v != v else int(v) if fmt == 'integer' else v for v in arr.tolist()]
+    return arr.tolist()
+
+
+def export_csv(rows):
+    header = next(rows)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([name for name, fmt in header])
+    for chunk in rows:
+        writer.writerows(zip(*[_csv_values(chunk[name], fmt) for name, fmt in header]))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+class _StreamSink:
+
+    # file-like sink for pyarrow that hands out what was written so far, tell() keeps counting
+    def __init__(self):
+        self._buf = io.BytesIO()
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buf.write(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = self._buf.getvalue()
+        self._buf.seek(0)
+        self._buf.truncate()
+        return data
+
+
+def export_parquet(rows):
+    if pa is None:
+        raise ValueError('parquet export needs pyarrow installed')
+    types = {'integer': pa.int64(), 'real': pa.float64(), 'text': pa.string()}
+    header = next(rows)
+    schema = pa.schema([(name, types.get(fmt, pa.string())) for name, fmt in header])
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    # one row group per chunk
+    for chunk in rows:
+        writer.write_table(pa.table([pa.array(chunk[f.name], type=f.type, from_pandas=True) for f in schema],
+                                    schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def channel_value(name, device, devices):
+    # dropdown value of a channel, prefixed with its port once there is more than one
+    return name if len(devices) < 2 else f'{device_tag(device)}:{name}'
+
+
+def channel_options(hdr_data, fmts=None):
+    devices = header_devices(hdr_data)
+    rows = sorted((row for row in hdr_data or [] if row and row.get('name') is not None),
+                  key=lambda row: (devices.index(row.get('device')), row['pos']))
+    values = [channel_value(row['name'], row.get('device'), devices) for row in rows
+              if fmts is None or row.get('fmt') in fmts]
+    return [{'label': value, 'value': value} for value in values]
+
+
+def figure_x_options(hdr_data):
+    return ([{'label': 'index', 'value': 'index'}] +
+            [{'label': hdr['name'], 'value': hdr['name']} for hdr in HOST_HEADER] +
+            channel_options(hdr_data))
+
+
+def figure_y_options(hdr_data):
+    # host columns are per device, as y they only name one with a single port
+    return channel_options(hdr_data) + ([{'label': hdr['name'], 'value': hdr['name']} for hdr in HOST_HEADER]
+                                        if len(header_devices(hdr_data)) < 2 else [])
+
+
+def figure_groups(filename, hdr_data, x_value, y_values):
+    # [(capture file, x column, [(y value, column)])], one group per file the traces come from
+    shared = ['index'] + [hdr['name'] for hdr in HOST_HEADER]
+    x_file, x_name = (None, x_value) if x_value in shared else resolve_channel(filename, hdr_data, x_value)
+    groups = OrderedDict()
+    for value in y_values:
+        file, name = resolve_channel(filename, hdr_data, value)
+        if file is None or (x_file is not None and file != x_file):
+            # a device's own channel as x only lines up with that device's channels, host time lines up all
+            continue
+        groups.setdefault(file, []).append((value, name))
+    return [(file, x_name, ys) for file, ys in groups.items()]
+
+
+def format_readout(y):
+    if y is None:
+        return '-'
+    if isinstance(y, (int, float, np.number)):
+        return f"{y:0.3g}"
+    return str(y)
+
+
+def format_stats(stats):
+    if stats is None:
+        return []
+    return [f'mean {format_readout(stats["mean"])} \u00b1 {format_readout(stats["std"])}',
+            f'min {format_readout(stats["min"])} / max {format_readout(stats["max"])}',
+            f'ema {format_readout(stats["ema"])}',
+            f'{format_readout(stats["rate_of_change"])} /s, {format_readout(stats["sample_rate"])} Hz']
 
 
 # layout
@@ -66,9 +514,11 @@ layout = dbc.Container([
         dbc.Col([
             dcc.Store(id=f'{APP_ID}_store'),
             dcc.Interval(id=f'{APP_ID}_interval',
-                         interval=2000,
+                         interval=POLL_INTERVAL,
                          n_intervals=0,
                          disabled=True),
+            # clicked by the page's /events listener whenever new rows arrive
+            html.Button(id=f'{APP_ID}_push_button', style={'display': 'none'}),
             html.H2('Serial Data Plotter'),
             html.P('This tests plotting data from serial (arduino) using a background thread to collect the data and send it to a queue.  '
                    'Data is retrieved from the queue and stored in the browser as well as written to a file')
@@ -79,10 +529,28 @@ layout = dbc.Container([
             dbc.FormGroup([
                 dbc.Button('COM Ports (refresh)', id=f'{APP_ID}_com_button'),
                 dcc.Dropdown(id=f'{APP_ID}_com_dropdown',
-                             placeholder='Select COM port',
+                             placeholder='Select COM ports',
                              options=[],
-                             multi=False),
-                dbc.Textarea(id=f'{APP_ID}_com_desc_label', disabled=True )
+                             multi=True),
+                dbc.Textarea(id=f'{APP_ID}_com_desc_label', disabled=True ),
+                dbc.Label('Baud rate'),
+                dcc.Dropdown(id=f'{APP_ID}_baud_dropdown',
+                             options=[{'label': str(b), 'value': b} for b in BAUD_RATES],
+                             value=115200,
+                             clearable=False),
+                dbc.Label('Protocol'),
+                dcc.Dropdown(id=f'{APP_ID}_protocol_dropdown',
+                             options=[{'label': 'json lines', 'value': 'json'},
+                                      {'label': 'binary (cobs framed)', 'value': 'binary'}],
+                             value='json',
+                             clearable=False),
+                dbc.Label('When the write queue is full'),
+                dcc.Dropdown(id=f'{APP_ID}_overflow_dropdown',
+                             options=[{'label': 'block the reader', 'value': 'block'},
+                                      {'label': 'drop oldest lines', 'value': 'drop-oldest'},
+                                      {'label': 'spill to disk, replay later', 'value': 'spill'}],
+                             value='block',
+                             clearable=False),
             ]),
             width=4
         ),
@@ -90,9 +558,14 @@ layout = dbc.Container([
             dbc.FormGroup([
                 dbc.Label('Headers'),
                 dbc.Button('Initialize Headers', id=f'{APP_ID}_init_header_button', block=True),
+                html.Small(id=f'{APP_ID}_header_status', className='text-muted'),
+                dcc.Interval(id=f'{APP_ID}_discovery_interval', interval=DISCOVERY_INTERVAL, disabled=True),
+                # channels the devices started sending during the capture
+                dcc.Store(id=f'{APP_ID}_evolved_store', data=[]),
                 dash_table.DataTable(
                     id=f'{APP_ID}_header_dt',
                     columns=[
+                        {"name": 'Device', "id": 'device', "type": 'text', 'editable': False},
                         {"name": 'Position', "id": 'pos', "type": 'numeric', 'editable': False},
                         {"name": 'Name', "id": 'name', "type": 'text', 'editable': False},
                         {"name": 'Format', "id": 'fmt', "type": 'text', "presentation": 'dropdown'}
@@ -111,6 +584,18 @@ layout = dbc.Container([
             ]),
             width=4
         ),
+        dbc.Col(
+            dbc.FormGroup([
+                dbc.Label('Derived channels'),
+                dbc.Textarea(id=f'{APP_ID}_derived_input',
+                             placeholder='one per line, e.g.\ndT_C = s01_tempHJ_C - s01_tempCJ_C',
+                             rows=4,
+                             debounce=True),
+                html.Small(id=f'{APP_ID}_derived_status', className='text-muted'),
+                dcc.Store(id=f'{APP_ID}_derived_store', data=[]),
+            ]),
+            width=4
+        ),
     ]),
     dbc.Row(
         dbc.Col([
@@ -135,23 +620,81 @@ layout = dbc.Container([
                           type='text',
                           value=f'data/my_data_{datetime.now().strftime("%m.%d.%Y.%H.%M.%S")}.db')
             ])
-        )
+        ),
+        dbc.Col(
+            dbc.FormGroup([
+                dbc.Label('Storage'),
+                dcc.Dropdown(id=f'{APP_ID}_storage_dropdown',
+                             options=[{'label': 'sqlite', 'value': SqliteStore.NAME},
+                                      {'label': 'columnar (numeric only)', 'value': ColumnarStore.NAME}],
+                             value=SqliteStore.NAME,
+                             clearable=False)
+            ]),
+            width=2
+        ),
+        dbc.Col(
+            dbc.FormGroup([
+                dbc.Label('Device time column (clock alignment)'),
+                dcc.Dropdown(id=f'{APP_ID}_clock_dropdown',
+                             placeholder='none',
+                             options=[],
+                             value=None)
+            ]),
+            width=4
+        ),
     ]),
     dbc.ButtonGroup([
         dbc.Button('Start', id=f'{APP_ID}_start_button', n_clicks=0, disabled=True, size='lg', color='secondary'),
         dbc.Button('Stop', id=f'{APP_ID}_stop_button', n_clicks=0, disabled=True, size='lg', color='secondary'),
         dbc.Button('Clear', id=f'{APP_ID}_clear_button', n_clicks=0, disabled=True, size='lg'),
-        dbc.Button('Download Data', id=f'{APP_ID}_download_button', n_clicks=0, disabled=True, size='lg'),
+        dbc.Button('Download Data', id=f'{APP_ID}_download_button', n_clicks=0, disabled=True, size='lg',
+                   external_link=True),
     ],
         className='mt-2 mb-2'
     ),
-    html.H2('Data Readouts'),
-    dcc.Dropdown(
-        id=f'{APP_ID}_readouts_dropdown',
-        multi=True,
-        options=[],
-        value=None
+    dbc.Row([
+        dbc.Col(
+            dcc.Dropdown(id=f'{APP_ID}_export_format_dropdown',
+                         options=[{'label': 'csv', 'value': 'csv'}] +
+                                 ([{'label': 'parquet', 'value': 'parquet'}] if pa is not None else []),
+                         value='csv',
+                         clearable=False),
+            width=2
+        ),
+        dbc.Col(
+            dcc.Dropdown(id=f'{APP_ID}_export_columns_dropdown',
+                         placeholder='all channels',
+                         options=[],
+                         multi=True),
+            width=6
+        ),
+        dbc.Col(dbc.Input(id=f'{APP_ID}_export_start_input', type='number', min=0, placeholder='from row'), width=2),
+        dbc.Col(dbc.Input(id=f'{APP_ID}_export_stop_input', type='number', min=0, placeholder='to row'), width=2),
+    ],
+        className='mb-2'
     ),
+    html.Div(html.Small(id=f'{APP_ID}_parse_status', className='text-muted')),
+    html.Div(html.Small(id=f'{APP_ID}_clock_status', className='text-muted')),
+    html.H2('Data Readouts'),
+    dbc.Row([
+        dbc.Col(
+            dcc.Dropdown(
+                id=f'{APP_ID}_readouts_dropdown',
+                multi=True,
+                options=[],
+                value=None
+            ),
+        ),
+        dbc.Col(
+            dcc.Dropdown(
+                id=f'{APP_ID}_readouts_window_dropdown',
+                options=[{'label': f'stats over last {n} samples', 'value': n} for n in STATS_WINDOWS],
+                value=STATS_WINDOWS[1],
+                clearable=False
+            ),
+            width=3
+        ),
+    ]),
     dbc.CardDeck(
         id=f'{APP_ID}_readouts_card_deck'
     ),
@@ -164,63 +707,175 @@ layout = dbc.Container([
     html.Div(
         id=f'{APP_ID}_figure_div'
     ),
+
+    dbc.Button('Diagnostics', id=f'{APP_ID}_diag_button', color='link', className='mt-3'),
+    dbc.Collapse(
+        dbc.Card(dbc.CardBody([
+            html.Small(['Also served as ', html.A('/metrics', href='/metrics'), ' (text) and ',
+                        html.A('/metrics.json', href='/metrics.json')]),
+            html.Pre(id=f'{APP_ID}_diag_pre', className='mb-0'),
+        ])),
+        id=f'{APP_ID}_diag_collapse',
+        is_open=False
+    ),
 ])
 
 
 def add_dash(app):
 
+    @app.server.route('/metrics')
+    def serial_data_metrics_text():
+        return Response(METRICS.text(), mimetype='text/plain')
+
+    @app.server.route('/metrics.json')
+    def serial_data_metrics_json():
+        return jsonify(METRICS.snapshot())
+
+    @app.server.route(f'/{APP_ID}/events')
+    def serial_data_events():
+        return Response(stream_with_context(PUSH.stream(lambda: ENGINE.rows_received,
+                                                           lambda: METRICS.seconds(REFRESH_CALLBACKS))), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    # pushed refreshes: one EventSource per page, the interval only stays as a slow fallback once it is open
+    app.clientside_callback(
+        """
+        function(disabled) {
+            if (typeof EventSource === 'undefined') {
+                return %d;
+            }
+            if (!window.%s_events) {
+                window.%s_events = new EventSource('/%s/events');
+                window.%s_events.onmessage = function() {
+                    var button = document.getElementById('%s_push_button');
+                    if (button) {
+                        button.click();
+                    }
+                };
+            }
+            return %d;
+        }
+        """ % (POLL_INTERVAL, APP_ID, APP_ID, APP_ID, APP_ID, APP_ID, PUSH_FALLBACK_INTERVAL),
+        Output(f'{APP_ID}_interval', 'interval'),
+        Input(f'{APP_ID}_interval', 'disabled'),
+    )
+
+    @app.server.route(f'/{APP_ID}/rows')
+    def serial_data_rows():
+        # live rows of one capture file for any number of clients, see Engine.row_events
+        args = request.args
+        names = [name for name in args.get('names', '').split(',') if name]
+        try:
+            events = ENGINE.row_events(data_path(args.get('file', '')), names, args.get('from'))
+        except ValueError as e:
+            return Response(str(e), status=404, mimetype='text/plain')
+        return Response(stream_with_context(events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.server.route(f'/{APP_ID}/export')
+    def serial_data_export():
+        args = request.args
+        fmt = args.get('format', 'csv')
+        try:
+            path = data_path(args.get('file', ''))
+        except ValueError as e:
+            return Response(str(e), status=404, mimetype='text/plain')
+        if not Path(path).exists():
+            return Response('no such capture file', status=404, mimetype='text/plain')
+        columns = [c for c in args.get('columns', '').split(',') if c] or None
+        rows = export_rows(capture_catalog(args['file']), columns=columns,
+                           start=args.get('start') or None, stop=args.get('stop') or None,
+                           x=args.get('x') or None, x0=args.get('x0') or None, x1=args.get('x1') or None)
+        try:
+            # validates the request before the response starts streaming
+            header = next(rows)
+        except ValueError as e:
+            return Response(str(e), status=400, mimetype='text/plain')
+        rows = (r for part in ([header], rows) for r in part)
+
+        if fmt == 'parquet':
+            if pa is None:
+                return Response('parquet export needs pyarrow installed', status=400, mimetype='text/plain')
+            body, mimetype = export_parquet(rows), 'application/octet-stream'
+        else:
+            fmt, body, mimetype = 'csv', export_csv(rows), 'text/csv'
+        name = f'{Path(path).stem}.{fmt}'
+        return Response(stream_with_context(body), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
     @app.callback(
         [Output(f'{APP_ID}_header_dt', 'data'),
+         Output(f'{APP_ID}_header_status', 'children'),
          Output(f'{APP_ID}_header_toast', 'children'),
          Output(f'{APP_ID}_header_toast', 'is_open'),
+         Output(f'{APP_ID}_discovery_interval', 'disabled'),
+         Output(f'{APP_ID}_baud_dropdown', 'value'),
          ],
-        [Input(f'{APP_ID}_init_header_button', 'n_clicks')],
-        [State(f'{APP_ID}_com_dropdown', 'value')]
+        [Input(f'{APP_ID}_init_header_button', 'n_clicks'),
+         Input(f'{APP_ID}_discovery_interval', 'n_intervals'),
+         Input(f'{APP_ID}_com_dropdown', 'value')],
+        [State(f'{APP_ID}_baud_dropdown', 'value'),
+         State(f'{APP_ID}_protocol_dropdown', 'value'),
+         State(f'{APP_ID}_header_dt', 'data')]
     )
-    def serial_data_init_header(n_clicks, com):
-        if n_clicks is None or com is None:
+    @METRICS.timed
+    def serial_data_init_header(n_clicks, n_intervals, com, baud, protocol, data_header):
+        if n_clicks is None or not com:
             raise PreventUpdate
 
-        baud = 115200
+        # the engine listens to the ports in the background, the interval looks at the result until it is done
+        ports = [com] if isinstance(com, str) else com
+        trig = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
+        if trig == f'{APP_ID}_com_dropdown':
+            # a deselected port's channels leave the header, they are not captured
+            data = [row for row in data_header or [] if row.get('device') in [None] + ports]
+            try:
+                running = ENGINE.running
+            except ValueError as e:
+                return dash.no_update, str(e), '', False, dash.no_update, dash.no_update
+            if running or len(data) == len(data_header or []):
+                raise PreventUpdate
+            return data, f'{len(data)} channels', '', False, dash.no_update, dash.no_update
         try:
-            ser_obj = serial.Serial(port=com,
-                                    baudrate=baud,
-                                    parity=serial.PARITY_NONE,
-                                    stopbits=serial.STOPBITS_ONE,
-                                    timeout=10)
-            split_line = '_'
-            while split_line[0] != '{':
-                line = ser_obj.readline()
-                split_line = line.strip().decode("utf-8")
-
-            split_line = line.strip().decode("utf-8")
-            jdic = json.loads(split_line)
-            data = [{'pos': i, 'name': k} for i, k in enumerate(jdic.keys())]
-
-            for i, k in enumerate(jdic.keys()):
-                if isinstance(jdic[k], int):
-                    data[i].update({'fmt': 'integer'})
-                elif isinstance(jdic[k], float):
-                    data[i].update({'fmt': 'real'})
-                else:
-                    data[i].update({'fmt': 'text'})
-
-            ser_obj.close()
-            return data, '', False
-        except Exception as e:
+            if trig == f'{APP_ID}_init_header_button':
+                ENGINE.discover(ports, baud, protocol)
+                return (dash.no_update, f'listening to {", ".join(ports)}...', '', False, False, dash.no_update)
+            discovery = ENGINE.discovery(ports)
+        except ValueError as e:
+            return [{}], '', html.P(str(e)), True, True, dash.no_update
+        if not discovery['done']:
+            raise PreventUpdate
 
-            return [{}], html.P(str(e)), True
-        return data, '', False
+        results = {port: discovery['results'].get(port) or {'error': 'not listened to'} for port in ports}
+        errors = [html.P(f'{port}: {result["error"]}') for port, result in results.items() if 'error' in result]
+        if errors:
+            return [{}], '', errors, True, True, dash.no_update
+        bauds = {result['baud'] for result in results.values()}
+        if len(bauds) > 1:
+            return ([{}], '', html.P(f'the ports send at different baud rates ({", ".join(map(str, bauds))})'),
+                    True, True, dash.no_update)
+        data = [dict(row, device=port) for port in ports for row in results[port]['header']]
+        found = bauds.pop()
+        # ports being captured answer from their capture, without lines of their own
+        lines = sum(result['lines'] or 0 for result in results.values())
+        source = f'{lines} lines' if lines else 'the running capture'
+        return data, f'{len(data)} channels from {source} at {found} baud', '', False, True, found
 
 
     @app.callback(
         Output(f'{APP_ID}_com_dropdown', 'options'),
         [Input(f'{APP_ID}_com_button', 'n_clicks')]
     )
+    @METRICS.timed
     def serial_data_refresh_com_ports(n_clicks):
         if n_clicks is None:
             raise PreventUpdate
-        ports = [{'label': comport.device, 'value': comport.device} for comport in serial.tools.list_ports.comports()]
+        try:
+            comports = ENGINE.ports()
+        except ValueError as e:
+            # the capture daemon is not answering
+            return [{'label': str(e), 'value': '', 'disabled': True}]
+        ports = [{'label': comport['device'], 'value': comport['device']} for comport in comports]
         return ports
 
 
@@ -228,13 +883,15 @@ def add_dash(app):
         Output(f'{APP_ID}_com_desc_label', 'value'),
         [Input(f'{APP_ID}_com_dropdown', 'value')]
     )
+    @METRICS.timed
     def serial_data_com_desc(com):
-        if com is None:
+        if not com:
             raise PreventUpdate
-        ports = [comport.device for comport in serial.tools.list_ports.comports()]
-        idx = ports.index(com)
-        descs = [comport.description for comport in serial.tools.list_ports.comports()]
-        return descs[idx]
+        try:
+            descs = {comport['device']: comport['description'] for comport in ENGINE.ports()}
+        except ValueError as e:
+            return str(e)
+        return '\n'.join(f'{port}: {descs.get(port, "not connected")}' for port in com)
 
 
     @app.callback(
@@ -259,16 +916,21 @@ def add_dash(app):
          ],
         [
             State(f'{APP_ID}_com_dropdown', 'value'),
+            State(f'{APP_ID}_baud_dropdown', 'value'),
+            State(f'{APP_ID}_protocol_dropdown', 'value'),
+            State(f'{APP_ID}_overflow_dropdown', 'value'),
             State(f'{APP_ID}_filename_input', 'value'),
-            State(f'{APP_ID}_header_dt', 'data')
+            State(f'{APP_ID}_storage_dropdown', 'value'),
+            State(f'{APP_ID}_clock_dropdown', 'value'),
+            State(f'{APP_ID}_header_dt', 'data'),
+            State(f'{APP_ID}_derived_store', 'data'),
          ]
     )
-    def serial_data_start_stop(n_start, n_stop, n_clear, hdr_data, port, filename, data_header):
-        global SERIAL_THREAD
-        global Q
-
+    @METRICS.timed
+    def serial_data_start_stop(n_start, n_stop, n_clear, hdr_data, port, baud, protocol, overflow, filename,
+                               storage, clock_column, data_header, derived):
         ctx = dash.callback_context
-        if any([n_start is None, n_stop is None, port is None, hdr_data is None, n_clear is None]):
+        if any([n_start is None, n_stop is None, not port, hdr_data is None, n_clear is None]):
             raise PreventUpdate
         if pd.DataFrame(hdr_data).empty:
             raise PreventUpdate
@@ -279,7 +941,7 @@ def add_dash(app):
 
         trig = ctx.triggered[0]['prop_id'].split('.')[0]
         if trig == f'{APP_ID}_header_dt':
-            if len(data_header[0].keys()) == 3 and ~df_hdr.isnull().values.any():
+            if {'pos', 'name', 'fmt'} <= set(data_header[0].keys()) and ~df_hdr[['pos', 'name', 'fmt']].isnull().values.any():
                 return True, False, 'success', True, 'secondary', True, 'secondary', False, filename, True, False
             else:
                 return True, True, 'secondary', True, 'secondary', True, 'secondary', False, filename, True, False
@@ -289,19 +951,29 @@ def add_dash(app):
             print(f'starting: {filename}')
             if filename is None or filename == '':
                 filename = f'data/my_data_{datetime.now().strftime("%m.%d.%Y.%H.%M.%S")}.db'
+            # the file suffix selects the storage format
+            suffix = ColumnarStore.SUFFIX if storage == ColumnarStore.NAME else SqliteStore.SUFFIX
+            filename = str(Path(filename).with_suffix(suffix))
             if (Path(FILE_DIR) / filename).exists():
                 clear = False
             else:
                 clear = True
-            SERIAL_THREAD = SerialThread(port, baud=115200)
-            SERIAL_THREAD.start()
+            try:
+                ENGINE.start(FILE_DIR + filename, data_header, port, baud=baud, protocol=protocol, overflow=overflow,
+                             clock_column=clock_column, derived=derived)
+            except ValueError as e:
+                print(f'could not start: {e}')
+                return True, False, 'success', True, 'secondary', True, 'secondary', False, filename, True, False
             return False, True, 'secondary', False, 'danger', True, 'secondary', True, filename, False, clear
 
         if trig == f'{APP_ID}_stop_button':
             print('stopping')
-            SERIAL_THREAD.stop()
-            with Q.mutex:
-                Q.queue.clear()
+            try:
+                ENGINE.stop()
+            except ValueError as e:
+                # still capturing as far as anyone knows, the status line shows why the daemon did not answer
+                print(f'could not stop: {e}')
+                return False, True, 'secondary', False, 'danger', True, 'secondary', True, filename, False, False
             return True, False, 'success', True, 'secondary', False, 'warning', False, filename, True, False
 
         if trig == f'{APP_ID}_clear_button':
@@ -312,58 +984,189 @@ def add_dash(app):
 
     @app.callback(
         Output(f'{APP_ID}_store', 'data'),
-        [Input(f'{APP_ID}_interval', 'n_intervals')],
-        [State(f'{APP_ID}_interval', 'disabled'),
-         State(f'{APP_ID}_store', 'data'),
-         State(f'{APP_ID}_filename_input', 'value'),
-         State(f'{APP_ID}_header_dt', 'data')
-         ]
+        [Input(f'{APP_ID}_interval', 'n_intervals'),
+         Input(f'{APP_ID}_push_button', 'n_clicks')],
+        [State(f'{APP_ID}_interval', 'disabled')]
     )
-    def serial_data_update_store(n_intervals, disabled, data, filename, data_header):
-        global Q
-        # get data from queue
-        if disabled is not None and not disabled:
-            new_data = []
-            while not Q.empty():
-                new_data_dic = json.loads(Q.get())
-                new_data.append(tuple((new_data_dic[c["name"]] for c in data_header if c["name"] in new_data_dic.keys())))
-
-            conn = sqlite3.connect(FILE_DIR + filename)
-            c = conn.cursor()
-
-            c.execute(''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='my_data' ''')
-            if c.fetchone()[0] == 1:
-                c.executemany(f'INSERT INTO my_data VALUES ({(",".join(["?"] * len(data_header)) )})', new_data)
-                conn.commit()
-                last_row_id = c.execute("SELECT COUNT() FROM my_data").fetchone()[0]
-                conn.close()
-            else:
-                c.execute(
-                    f'''CREATE TABLE my_data
-                    (''' + ', '.join([f'{hdr["name"]} {hdr["fmt"]}' for hdr in data_header])
-                    + ')'
-                )
-                c.executemany(f'INSERT INTO my_data VALUES ({(",".join(["?"] * len(data_header)) )})', new_data)
-                conn.commit()
-                last_row_id = c.execute("SELECT COUNT() FROM my_data").fetchone()[0]
-                conn.close()
-            return last_row_id
+    @METRICS.timed
+    def serial_data_update_store(n_intervals, n_pushed, disabled):
+        # rows are written by the engine, the store only carries the row count seen so far
+        if disabled is None or disabled or ENGINE.rows_received is None:
+            raise PreventUpdate
+        return ENGINE.rows_received
 
 
     @app.callback(
-        Output(f'{APP_ID}_readouts_dropdown', 'options'),
+        Output(f'{APP_ID}_parse_status', 'children'),
+        Output(f'{APP_ID}_evolved_store', 'data'),
+        Input(f'{APP_ID}_store', 'modified_timestamp'),
+        State(f'{APP_ID}_evolved_store', 'data'),
+    )
+    @METRICS.timed
+    def serial_data_parse_status(ts, evolved):
+        if ts is None:
+            raise PreventUpdate
+        try:
+            engine_status = ENGINE.status()
+        except ValueError as e:
+            return str(e), dash.no_update
+        if engine_status is None:
+            raise PreventUpdate
+        statuses = []
+        added = []
+        for capture in engine_status['captures']:
+            errors = capture['errors']
+            status = (f'{capture["rows"]} rows written, {errors["lines"]} lines read, '
+                      f'{errors["malformed"]} malformed, {errors["partial"]} partial, '
+                      f'{errors["mismatched"]} type mismatched')
+            if capture['added']:
+                status += f', new channels {", ".join(hdr["name"] for hdr in capture["added"])}'
+            if capture['last_error']:
+                status += f' (last bad line: {capture["last_error"]})'
+            if len(engine_status['captures']) > 1:
+                status = f'{capture["key"]}: {status}'
+            statuses.append(status)
+            added += [dict(hdr, device=capture['key']) for hdr in capture['added']]
+        if engine_status.get('error'):
+            statuses.insert(0, f'capture stopped: {engine_status["error"]}')
+        return '; '.join(statuses), added if added != evolved else dash.no_update
+
+
+    @app.callback(
+        Output(f'{APP_ID}_diag_collapse', 'is_open'),
+        Input(f'{APP_ID}_diag_button', 'n_clicks'),
+        State(f'{APP_ID}_diag_collapse', 'is_open'),
+    )
+    @METRICS.timed
+    def serial_data_toggle_diagnostics(n_clicks, is_open):
+        if n_clicks is None:
+            raise PreventUpdate
+        return not is_open
+
+
+    @app.callback(
+        Output(f'{APP_ID}_diag_pre', 'children'),
+        Input(f'{APP_ID}_store', 'modified_timestamp'),
+        Input(f'{APP_ID}_diag_collapse', 'is_open'),
+    )
+    @METRICS.timed
+    def serial_data_update_diagnostics(ts, is_open):
+        if not is_open:
+            raise PreventUpdate
+        return METRICS.text()
+
+
+    @app.callback(
+        Output(f'{APP_ID}_clock_status', 'children'),
+        Input(f'{APP_ID}_store', 'modified_timestamp'),
+    )
+    @METRICS.timed
+    def serial_data_clock_status(ts):
+        if ts is None:
+            raise PreventUpdate
+        try:
+            engine_status = ENGINE.status()
+        except ValueError:
+            raise PreventUpdate
+        clock = next((capture['clock'] for capture in (engine_status or {}).get('captures', []) if capture['clock']),
+                     None)
+        if clock is None:
+            raise PreventUpdate
+        fit = clock['fit']
+        if fit is None:
+            return f'clock alignment on {clock["column"]}: waiting for data'
+        drift = 'unknown' if fit['drift_ppm'] is None else f'{fit["drift_ppm"]:0.1f} ppm'
+        return (f'clock alignment on {clock["column"]}: {fit["n"]} rows, drift {drift}, '
+                f'jitter {fit["jitter_ms"]:0.2f} ms, receive lag p50 {fit["lag_p50_ms"]:0.2f} ms '
+                f'/ p99 {fit["lag_p99_ms"]:0.2f} ms / max {fit["lag_max_ms"]:0.2f} ms')
+
+
+    @app.callback(
+        Output(f'{APP_ID}_clock_dropdown', 'options'),
+        Output(f'{APP_ID}_clock_dropdown', 'value'),
         Input(f'{APP_ID}_header_dt', 'data')
     )
-    def serial_data_readout_options(hdr_data):
+    @METRICS.timed
+    def serial_data_clock_options(hdr_data):
+        if hdr_data is None or pd.DataFrame(hdr_data).empty:
+            raise PreventUpdate
+        options = channel_options(hdr_data, ('integer', 'real'))
+        guess = next((option['value'] for option in options if 'time' in option['value'].lower()), None)
+        return options, guess
+
+
+    @app.callback(
+        Output(f'{APP_ID}_download_button', 'href'),
+        Output(f'{APP_ID}_download_button', 'disabled'),
+        Input(f'{APP_ID}_filename_input', 'value'),
+        Input(f'{APP_ID}_export_format_dropdown', 'value'),
+        Input(f'{APP_ID}_export_columns_dropdown', 'value'),
+        Input(f'{APP_ID}_export_start_input', 'value'),
+        Input(f'{APP_ID}_export_stop_input', 'value'),
+        Input(f'{APP_ID}_store', 'modified_timestamp'),
+        State(f'{APP_ID}_header_dt', 'data'),
+    )
+    @METRICS.timed
+    def serial_data_export_link(filename, fmt, columns, start, stop, ts, hdr_data):
+        if filename is None:
+            return None, True
+        # one export is one capture file, the host columns come from whichever device the channels belong to
+        devices = header_devices(hdr_data)
+        host = [hdr['name'] for hdr in HOST_HEADER]
+        resolved = [resolve_channel(filename, hdr_data, column) for column in columns or [] if column not in host]
+        files = {file for file, _ in resolved}
+        if len(files) > 1 or None in files:
+            return None, True
+        file = files.pop() if files else device_filename(filename, devices[0] if devices else None, devices)
+        names = [name for _, name in resolved] + [column for column in columns or [] if column in host]
+        if not (Path(FILE_DIR) / file).exists():
+            return None, True
+        params = {'file': file, 'format': fmt, 'columns': ','.join(names),
+                  'start': '' if start is None else start, 'stop': '' if stop is None else stop}
+        return f'/{APP_ID}/export?{urlencode(params)}', False
+
+
+    @app.callback(
+        Output(f'{APP_ID}_export_columns_dropdown', 'options'),
+        Input(f'{APP_ID}_readouts_dropdown', 'options'),
+    )
+    @METRICS.timed
+    def serial_data_export_options(options):
+        if options is None:
+            raise PreventUpdate
+        return options + [{'label': hdr['name'], 'value': hdr['name']} for hdr in HOST_HEADER]
+
+
+    @app.callback(
+        Output(f'{APP_ID}_readouts_dropdown', 'options'),
+        Input(f'{APP_ID}_header_dt', 'data'),
+        Input(f'{APP_ID}_derived_store', 'data'),
+        Input(f'{APP_ID}_evolved_store', 'data'),
+    )
+    @METRICS.timed
+    def serial_data_readout_options(hdr_data, derived, evolved):
         if hdr_data is None:
             raise PreventUpdate
         if pd.DataFrame(hdr_data).empty:
             raise PreventUpdate
-        df_hdr = pd.DataFrame(hdr_data).sort_values('pos')
-        df_hdr['name'] = df_hdr['name'].fillna(df_hdr['pos'].astype(str))
-        headers = df_hdr['name'].tolist()
-        options = [{'label': c, 'value': c} for c in headers]
-        return options
+        return channel_options(hdr_data + (evolved or []) + (derived or []))
+
+
+    @app.callback(
+        Output(f'{APP_ID}_derived_store', 'data'),
+        Output(f'{APP_ID}_derived_status', 'children'),
+        Input(f'{APP_ID}_derived_input', 'value'),
+        Input(f'{APP_ID}_header_dt', 'data'),
+    )
+    @METRICS.timed
+    def serial_data_derived(text, hdr_data):
+        if not text:
+            return [], ''
+        try:
+            derived = parse_derived(text, [row for row in hdr_data or [] if row])
+        except ValueError as e:
+            return [], str(e)
+        return derived, f'{len(derived)} derived channel{"s" if len(derived) != 1 else ""}'
 
 
     @app.callback(
@@ -372,6 +1175,7 @@ def add_dash(app):
         Input(f'{APP_ID}_readouts_card_deck', 'children'),
         Input(f'{APP_ID}_readouts_dropdown', 'value'),
     )
+    @METRICS.timed
     def serial_data_create_readouts(cards, selected):
 
         ctx = dash.callback_context
@@ -399,29 +1203,40 @@ def add_dash(app):
     @app.callback(
         Output({'type': f'{APP_ID}_readout_card', 'index': ALL}, 'children'),
         Input(f'{APP_ID}_store', 'modified_timestamp'),
+        Input(f'{APP_ID}_readouts_window_dropdown', 'value'),
         State(f'{APP_ID}_filename_input', 'value'),
+        State(f'{APP_ID}_header_dt', 'data'),
+        State(f'{APP_ID}_store', 'data'),
     )
-    def serial_data_update_readouts(ts, filename):
+    @METRICS.timed
+    def serial_data_update_readouts(ts, window, filename, hdr_data, rows_seen):
         if any([v is None for v in [ts]]):
             raise PreventUpdate
 
-        conn = sqlite3.connect(FILE_DIR + filename)
-        cur = conn.cursor()
-        n_estimate = cur.execute("SELECT COUNT() FROM my_data").fetchone()[0]
-        n_int = n_estimate // 10000 + 1
-        query = f'SELECT * FROM my_data WHERE ROWID % {n_int} = 0'
-        df = pd.read_sql(query, conn)
-        conn.close()
-
         card_chs = []
         for ccb in dash.callback_context.outputs_list:
-            y = df[ccb['id']['index']].iloc[-1]
+            file, name = resolve_channel(filename, hdr_data, ccb['id']['index'])
+            y = stats = None
+            if file is not None:
+                # last value and statistics come from the capture's ring buffers while it is running,
+                # from the file otherwise
+                try:
+                    live = ENGINE.live(FILE_DIR + file, name, window or STATS_WINDOWS[1])
+                except ValueError:
+                    live = None
+                if live is not None:
+                    y, stats = live['last'], live['stats']
+                else:
+                    snapshot = SNAPSHOTS.get(file, snapshot_key(ts, rows_seen))
+                    y = snapshot.last(name)
+                    stats = snapshot.stats(name, window or STATS_WINDOWS[1])
+            items = [dbc.ListGroupItem(html.H3(format_readout(y)), color='info')]
+            if stats is not None:
+                items.append(dbc.ListGroupItem([html.Div(html.Small(line)) for line in format_stats(stats)]))
             ch = [
                 dbc.CardHeader(ccb['id']['index']),
                 dbc.CardBody(
-                    dbc.ListGroup([
-                        dbc.ListGroupItem(html.H3(f"{y:0.3g}"), color='info'),
-                    ]),
+                    dbc.ListGroup(items),
                 )
                 ]
             card_chs.append(ch)
@@ -434,8 +1249,11 @@ def add_dash(app):
         Input(f'{APP_ID}_remove_figure_button', 'n_clicks'),
         Input(f'{APP_ID}_header_dt', 'data'),
         State(f'{APP_ID}_figure_div', 'children'),
+        State(f'{APP_ID}_derived_store', 'data'),
+        State(f'{APP_ID}_evolved_store', 'data'),
     )
-    def serial_data_create_figures(n_add, n_remove, header_data, figure_objs):
+    @METRICS.timed
+    def serial_data_create_figures(n_add, n_remove, header_data, figure_objs, derived, evolved):
 
         ctx = dash.callback_context
         input_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -468,9 +1286,7 @@ def add_dash(app):
                            dcc.Dropdown(
                                id={'type': f'{APP_ID}_plot_x_data', 'index': n_add},
                                value=None,
-                               options=
-                               [{'label': 'index', 'value': 'index'}] +
-                               [{'label': name, 'value': name} for name in df_header['name']],
+                               options=figure_x_options(header_data + (evolved or []) + (derived or [])),
                                multi=False
                            )
                        ]),
@@ -482,7 +1298,7 @@ def add_dash(app):
                            dcc.Dropdown(
                                id={'type': f'{APP_ID}_plot_y_data', 'index': n_add},
                                value=None,
-                               options=[{'label': name, 'value': name} for name in df_header['name']],
+                               options=figure_y_options(header_data + (evolved or []) + (derived or [])),
                                multi=True
                            )
                        ]),
@@ -492,9 +1308,10 @@ def add_dash(app):
                    className='mt-3'
                ),
                dbc.Row(
-                   dbc.Col(
+                   dbc.Col([
+                       dcc.Store(id={'type': f'{APP_ID}_plot_state', 'index': n_add}),
                        dcc.Graph(id={'type': f'{APP_ID}_plot_graph', 'index': n_add})
-                   ),
+                   ]),
                    className='mt-2'
                )
             ])
@@ -509,48 +1326,133 @@ def add_dash(app):
                 figure_objs = [fobj for fobj in figure_objs if f'{APP_ID}_plot_graph' in str(fobj)]
             return figure_objs[:-1]
 
+    @app.callback(
+        Output({'type': f'{APP_ID}_plot_x_data', 'index': ALL}, 'options'),
+        Output({'type': f'{APP_ID}_plot_y_data', 'index': ALL}, 'options'),
+        Input(f'{APP_ID}_evolved_store', 'data'),
+        State(f'{APP_ID}_header_dt', 'data'),
+        State(f'{APP_ID}_derived_store', 'data'),
+    )
+    @METRICS.timed
+    def serial_data_figure_options(evolved, hdr_data, derived):
+        # plots added before a device grew channels offer them too
+        n_figures = len(dash.callback_context.outputs_list[0])
+        if not hdr_data or not n_figures:
+            raise PreventUpdate
+        hdr = hdr_data + (evolved or []) + (derived or [])
+        return [figure_x_options(hdr)] * n_figures, [figure_y_options(hdr)] * n_figures
+
     @app.callback(
         Output({'type': f'{APP_ID}_plot_graph', 'index': MATCH}, 'figure'),
+        Output({'type': f'{APP_ID}_plot_graph', 'index': MATCH}, 'extendData'),
+        Output({'type': f'{APP_ID}_plot_state', 'index': MATCH}, 'data'),
         Input(f'{APP_ID}_store', 'modified_timestamp'),
         Input({'type': f'{APP_ID}_plot_x_data', 'index': MATCH}, 'value'),
         Input({'type': f'{APP_ID}_plot_y_data', 'index': MATCH}, 'value'),
+        Input({'type': f'{APP_ID}_plot_graph', 'index': MATCH}, 'relayoutData'),
+        State({'type': f'{APP_ID}_plot_state', 'index': MATCH}, 'data'),
         State(f'{APP_ID}_filename_input', 'value'),
+        State(f'{APP_ID}_header_dt', 'data'),
+        State(f'{APP_ID}_store', 'data'),
     )
-    def serial_data_update_figures(ts, x_data, y_data, filename):
-        if any([v is None for v in [ts, x_data, y_data]]):
+    @METRICS.timed
+    def serial_data_update_figures(ts, x_data, y_data, relayout, state, filename, hdr_data, rows_seen):
+        if any([v is None for v in [ts, x_data, y_data]]) or len(y_data) == 0:
             raise PreventUpdate
 
-        conn = sqlite3.connect(FILE_DIR + filename)
-        cur = conn.cursor()
-        n_estimate = cur.execute("SELECT COUNT() FROM my_data").fetchone()[0]
-        n_int = n_estimate // 10000 + 1
-        query = f'SELECT * FROM my_data WHERE ROWID % {n_int} = 0'
-        df = pd.read_sql(query, conn)
-        conn.close()
+        trig = dash.callback_context.triggered[0]['prop_id']
+        state = state or {}
+        same = [state.get('file'), state.get('x'), state.get('y')] == [filename, x_data, y_data]
+        xrange = state.get('xrange') if same else None
+        if trig.endswith('.relayoutData'):
+            relayout = relayout or {}
+            if 'xaxis.range[0]' in relayout:
+                xrange = [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+            elif 'xaxis.range' in relayout:
+                xrange = relayout['xaxis.range']
+            elif relayout.get('xaxis.autorange'):
+                xrange = None
+            else:
+                # pan mode, legend clicks, autosize...
+                raise PreventUpdate
+            if same and xrange == state.get('xrange'):
+                raise PreventUpdate
+
+        # traces from several ports are drawn from each port's own capture file
+        groups = figure_groups(filename, hdr_data, x_data, y_data)
+        if not groups:
+            raise PreventUpdate
+        snapshots = {file: SNAPSHOTS.get(file, snapshot_key(ts, rows_seen)) for file, _, _ in groups}
+        rows = {file: snapshot.n_rows for file, snapshot in snapshots.items()}
+        trig = trig.split('.')[0]
+        redraw = trig != f'{APP_ID}_store' or not same or set(state.get('rows', {})) != set(rows)
+
+        if xrange is not None:
+            # zoomed in: draw the visible window only, new rows are not appended until the zoom is reset
+            if not redraw or not all([ensure_index(file, x_name) for file, x_name, _ in groups]):
+                raise PreventUpdate
+            traces = [(snapshots[file].window(x_name, [name for _, name in ys], *xrange), ys)
+                      for file, x_name, ys in groups]
+            state = dict(file=filename, x=x_data, y=y_data, rows=rows, extended=0, xrange=xrange)
+        elif not redraw:
+            # append only the rows this graph has not seen yet
+            new_rows = sum(rows[file] - state['rows'][file] for file in rows)
+            if not any(rows[file] > state['rows'][file] for file in rows):
+                raise PreventUpdate
+            news = None
+            if state['extended'] + new_rows <= PLOT_EXTEND_POINTS:
+                news = [snapshots[file].since(state['rows'][file], [x_name] + [name for _, name in ys])
+                        for file, x_name, ys in groups]
+            if news is not None and all(new is not None for new in news):
+                xs, ys_new = [], []
+                for new, (file, x_name, ys) in zip(news, groups):
+                    xs += [new[x_name]] * len(ys)
+                    ys_new += [new[name] for _, name in ys]
+                extend = [
+                    dict(x=xs, y=ys_new),
+                    list(range(len(ys_new))),
+                    PLOT_POINTS + PLOT_EXTEND_POINTS,
+                ]
+                state.update(rows=rows, extended=state['extended'] + new_rows)
+                return dash.no_update, extend, state
+
+        if xrange is None:
+            traces = [(snapshots[file].columns(x_name, [name for _, name in ys]), ys) for file, x_name, ys in groups]
+            state = dict(file=filename, x=x_data, y=y_data, rows=rows, extended=0)
 
-        if x_data == 'index':
-            x = df.index
-        else:
-            x = df[x_data]
         fig = go.Figure()
         fig.update_layout(
             margin=dict(l=20, r=20, t=10, b=10),
+            # keeps the user's zoom across redraws of the same selection
+            uirevision=f'{filename} {x_data} {y_data}',
         )
-        for y_c in y_data:
-            fig.add_trace(
-                go.Scatter(
-                    x=x,
-                    y=df[y_c],
-                    name=y_c
+        if xrange is not None:
+            fig.update_xaxes(range=xrange)
+        for (x, df), ys in traces:
+            for value, name in ys:
+                fig.add_trace(
+                    go.Scatter(
+                        x=x,
+                        y=df[name],
+                        name=value
+                    )
                 )
-            )
 
-        return fig
+        return fig, dash.no_update, state
 
     return app
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serial data capture web app')
+    parser.add_argument('--engine', metavar='URL',
+                        help='attach to a capture daemon (capture_engine.py --api) instead of capturing in this process')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    args = parser.parse_args()
+    if args.engine:
+        ENGINE = RemoteEngine(args.engine)
+
     # app
     external_stylesheets = [
         dbc.themes.BOOTSTRAP,
@@ -559,4 +1461,5 @@ if __name__ == '__main__':
     app.layout = layout
     app = add_dash(app)
 
-    app.run_server(debug=True)
\ No newline at end of file
+    # the reloader would run a second copy of the module and restart it, captures included, on every edit
+    app.run_server(debug=True, use_reloader=False, host=args.host, port=args.port)
\ No newline at end of file
@@ -0,0 +1,414 @@
+import binascii
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import capture_engine as engine
+
+
+def cobs_encode(payload):
+    # the device side of the framing, without the 0x00 delimiter the reader splits on
+    out = bytearray()
+    block = bytearray()
+    for b in payload + b'\x00':
+        if b == 0:
+            out.append(len(block) + 1)
+            out += block
+            block = bytearray()
+        else:
+            block.append(b)
+            if len(block) == 254:
+                out.append(0xFF)
+                out += block
+                block = bytearray()
+    return bytes(out)
+
+
+def binary_frame(parser, values):
+    record = np.array([tuple(values)], dtype=parser.dtype).tobytes()
+    return cobs_encode(record + binascii.crc_hqx(record, 0xFFFF).to_bytes(2, 'little'))
+
+
+def make_header(names):
+    return [{'pos': i, 'name': name, 'fmt': fmt} for i, (name, fmt) in enumerate(names)]
+
+
+@pytest.fixture
+def fresh_queue():
+    engine.Q.configure()
+    yield engine.Q
+    engine.Q.configure()
+
+
+def counter(name):
+    return engine.METRICS.snapshot()['counters'].get(name, {}).get('total', 0)
+
+
+# framing
+
+@pytest.mark.parametrize('payload', [b'', b'\x00', b'\x00\x00', b'abc', b'a\x00b\x00', bytes(range(1, 255)),
+                                     bytes(range(1, 255)) + b'\x00x', bytes(600)])
+def test_cobs_decode_round_trip(payload):
+    assert engine.cobs_decode(cobs_encode(payload)) == payload
+
+
+def test_cobs_decode_rejects_a_bad_code_byte():
+    with pytest.raises(ValueError):
+        engine.cobs_decode(b'\x05ab')
+
+
+def test_cobs_decode_block_matches_cobs_decode():
+    rng = np.random.default_rng(1)
+    payloads = [bytes(rng.integers(0, 4, 10, dtype=np.uint8)) for _ in range(50)]
+    frames = np.frombuffer(b''.join(cobs_encode(p) for p in payloads), dtype=np.uint8).reshape(50, 11)
+    out, ok = engine.cobs_decode_block(frames)
+    assert ok.all()
+    assert [bytes(row) for row in out] == payloads
+    frames = frames.copy()
+    frames[3, 0] = 0
+    assert not engine.cobs_decode_block(frames)[1][3]
+
+
+def test_crc16_block_matches_crc_hqx():
+    data = np.random.default_rng(2).integers(0, 256, (20, 13), dtype=np.uint8)
+    assert engine.crc16_block(data).tolist() == [binascii.crc_hqx(bytes(row), 0xFFFF) for row in data]
+
+
+def test_binary_parser_fixed_frames():
+    parser = engine.BinaryParser(make_header([('t', 'integer'), ('v', 'real')]))
+    frames = [binary_frame(parser, (i, i / 2)) for i in range(5)]
+    bad = bytearray(frames[2])
+    bad[-1] ^= 0x01
+    frames[2] = bytes(bad)
+    assert parser.parse(frames) == [(0, 0.0), (1, 0.5), (3, 1.5), (4, 2.0)]
+    assert parser.errors()['malformed'] == 1
+
+
+def test_binary_parser_long_frames():
+    # 70 real channels: a 282 byte record + crc, cobs needs an extra code byte for a zero free run
+    names = [(f'ch{i}', 'real') for i in range(70)]
+    parser = engine.BinaryParser(make_header(names))
+    values = [tuple(float(i + j + 1) for j in range(70)) for i in range(3)]
+    frames = [binary_frame(parser, row) for row in values]
+    assert parser.parse(frames) == [tuple(np.float32(v) for v in row) for row in values]
+    assert parser.errors()['malformed'] == 0
+
+
+def test_binary_parser_skips_header_frames():
+    header = make_header([('t', 'integer'), ('v', 'real')])
+    parser = engine.BinaryParser(header)
+    handshake = cobs_encode(json.dumps({'t': 0, 'v': 0.0}).encode())
+    frames = [binary_frame(parser, (1, 1.0)), handshake, binary_frame(parser, (2, 2.0))]
+    assert parser.parse(frames) == [(1, 1.0), (2, 2.0)]
+    assert parser.errors() == {'lines': 2, 'malformed': 0, 'partial': 0, 'mismatched': 0}
+    assert not hasattr(parser, 'json_header')
+
+
+# header discovery
+
+class FakeSerial:
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def read(self, n):
+        chunk, self.data = self.data[:n], self.data[n:]
+        if not chunk:
+            time.sleep(0.01)
+        return chunk
+
+
+def test_discovery_keeps_the_binary_header_frame_sent_first():
+    header = make_header([('t', 'integer'), ('v', 'real')])
+    parser = engine.BinaryParser(header)
+    data = cobs_encode(json.dumps({'t': 1, 'v': 0.5}).encode()) + b'\x00'
+    data += b''.join(binary_frame(parser, (i, 0.5)) + b'\x00' for i in range(5))
+    discovery = engine.HeaderDiscovery('/dev/null', protocol='binary')
+    objects, framed = discovery._sample(FakeSerial(data), 0.5, drop=False)
+    assert objects == [{'t': 1, 'v': 0.5}]
+
+
+def test_discovery_reads_lines_after_a_boot_banner():
+    data = b'ets Jun  8 2016 00:22:57\r\nboot: ok\r\n' + b''.join(b'{"t": %d, "v": 1.5}\n' % i for i in range(60))
+    discovery = engine.HeaderDiscovery('/dev/null')
+    objects, framed = discovery._sample(FakeSerial(data), 0.5)
+    assert len(objects) == discovery.SAMPLE_LINES
+    assert engine.infer_header(objects) == [{'pos': 0, 'name': 't', 'fmt': 'integer'},
+                                            {'pos': 1, 'name': 'v', 'fmt': 'real'}]
+
+
+# capture queue
+
+def batch(i, n=10, key='a'):
+    return [json.dumps({'i': i, 'j': j}) for j in range(n)], i, i, key
+
+
+def test_queue_drop_oldest(fresh_queue):
+    fresh_queue.configure(max_lines=25, policy='drop-oldest')
+    for i in range(4):
+        fresh_queue.put(batch(i))
+    assert [fresh_queue.get(timeout=0)[1] for _ in range(fresh_queue.qsize())] == [2, 3]
+
+
+def test_queue_block_waits_for_the_writer(fresh_queue):
+    fresh_queue.configure(max_lines=20, policy='block')
+    fresh_queue.put(batch(0))
+    fresh_queue.put(batch(1))
+    putter = threading.Thread(target=fresh_queue.put, args=(batch(2),))
+    putter.start()
+    putter.join(0.3)
+    assert putter.is_alive()
+    assert fresh_queue.get(timeout=0)[1] == 0
+    putter.join(2)
+    assert not putter.is_alive()
+    assert [fresh_queue.get(timeout=0)[1] for _ in range(2)] == [1, 2]
+
+
+def test_queue_abandon_releases_a_blocked_put(fresh_queue):
+    fresh_queue.configure(max_lines=10, policy='block')
+    fresh_queue.put(batch(0))
+    putter = threading.Thread(target=fresh_queue.put, args=(batch(1),))
+    putter.start()
+    fresh_queue.abandon()
+    putter.join(2)
+    assert not putter.is_alive()
+    assert fresh_queue.empty()
+
+
+def test_queue_spill_keeps_order_and_binary_lines(fresh_queue, tmp_path):
+    spill = str(tmp_path / 'q.spill')
+    fresh_queue.configure(max_lines=20, policy='spill', spill_path=spill)
+    for i in range(5):
+        fresh_queue.put(batch(i))
+    frames = [b'\x01\x00\xff', b'\x02']
+    fresh_queue.put((frames, 5, 5, 'a'))
+    got = [fresh_queue.get(timeout=0) for _ in range(fresh_queue.qsize())]
+    assert [b[1] for b in got] == [0, 1, 2, 3, 4, 5]
+    assert got[2] == batch(2)
+    assert got[5] == (frames, 5, 5, 'a')
+    fresh_queue.confirm()
+    assert not (tmp_path / 'q.spill').exists()
+
+
+def test_queue_spill_replays_only_what_was_not_confirmed(fresh_queue, tmp_path):
+    spill = str(tmp_path / 'q.spill')
+    fresh_queue.configure(max_lines=10, policy='spill', spill_path=spill)
+    for i in range(6):
+        fresh_queue.put(batch(i))
+    # batch 0 from memory, 1 and 2 replayed from the journal and committed, 3 taken but lost in the crash
+    for _ in range(3):
+        fresh_queue.get(timeout=0)
+    fresh_queue.confirm()
+    fresh_queue.get(timeout=0)
+    # a record cut off by the crash
+    with open(spill, 'ab') as f:
+        f.write(engine.CaptureQueue.SPILL_LENGTH.pack(100) + b'{"lines"')
+
+    resumed = engine.CaptureQueue(max_lines=10, policy='spill', spill_path=spill)
+    assert [resumed.get(timeout=0)[1] for _ in range(resumed.qsize())] == [3, 4, 5]
+    # the next session appends after the last whole record
+    resumed = engine.CaptureQueue(max_lines=10, policy='spill', spill_path=spill)
+    resumed.put(batch(6))
+    assert [resumed.get(timeout=0)[1] for _ in range(resumed.qsize())] == [3, 4, 5, 6]
+
+
+def test_writer_drops_batches_for_ports_it_does_not_capture(fresh_queue, tmp_path):
+    capture = engine.Capture(str(tmp_path / 'a.db'), make_header([('i', 'integer'), ('j', 'integer')]), key='a')
+    fresh_queue.put(batch(0, key='gone'))
+    fresh_queue.put(batch(1, key='a'))
+    unrouted = counter('queue_unrouted_lines')
+    writer = engine.StoreWriter([capture])
+    writer.start()
+    writer.stop()
+    assert writer.error is None
+    assert capture.row_count == 10
+    assert counter('queue_unrouted_lines') == unrouted + 10
+
+
+# ring buffers, statistics and the decimator
+
+def test_ring_buffer_window_is_the_newest_values():
+    ring = engine.RingBuffer(8)
+    for start in range(0, 30, 7):
+        ring.extend(np.arange(start, start + 7, dtype=float))
+    assert ring.window().tolist() == list(range(27, 35))
+    assert ring.window(3).tolist() == [32, 33, 34]
+    assert ring.last() == 34
+
+
+def test_recent_data_keeps_integers_exact(tmp_path):
+    capture = engine.Capture(str(tmp_path / 'a.db'), make_header([('t', 'integer'), ('v', 'real')]))
+    capture.open()
+    big = 2 ** 53 + 1
+    capture.add([json.dumps({'t': big, 'v': 1.5}), json.dumps({'t': big + 2, 'v': 2.5})], 2 ** 62 + 1, 1e9)
+    columns = capture.recent.columns(['t', 'host_mono_ns'])
+    assert columns['t'].tolist() == [big, big + 2]
+    assert columns['host_mono_ns'].tolist() == [2 ** 62 + 1] * 2
+    capture.add([json.dumps({'v': 3.5})], 2 ** 62 + 2, 1e9)
+    assert np.isnan(capture.recent.last('t'))
+    assert np.isnan(capture.recent.columns(['t'])['t'][-1])
+    capture.close()
+
+
+@pytest.mark.parametrize('offset', [0.0, 1e9])
+def test_rolling_stats_match_numpy(offset):
+    rng = np.random.default_rng(3)
+    stats = engine.RollingStats(1000)
+    values = offset + rng.normal(size=5000)
+    values[rng.integers(0, 5000, 100)] = np.nan
+    times = np.arange(5000) * 0.01
+    for lo in range(0, 5000, 333):
+        stats.extend(values[lo:lo + 333], times[lo:lo + 333])
+    for window in [1, 100, 1000]:
+        tail = values[-window:]
+        got = stats.summary(window)
+        finite = tail[np.isfinite(tail)]
+        assert got['n'] == len(finite)
+        assert got['mean'] == pytest.approx(finite.mean(), rel=1e-12, abs=1e-12)
+        if len(finite) > 1:
+            assert got['std'] == pytest.approx(finite.std(ddof=1), rel=1e-9)
+        assert got['min'] == finite.min()
+        assert got['max'] == finite.max()
+        if window > 1:
+            assert got['sample_rate'] == pytest.approx(100)
+
+
+def test_rolling_stats_prefix_sums_stay_bounded():
+    stats = engine.RollingStats(100)
+    for i in range(200):
+        stats.extend(np.full(50, 1e6), np.arange(i * 50, (i + 1) * 50, dtype=float))
+    # rebased every capacity samples, the sums never hold more than about two windows
+    assert stats.prefix['n'].last() <= 250
+    assert stats.summary(100)['n'] == 100
+
+
+def test_decimator_batches_match_one_pass():
+    rng = np.random.default_rng(4)
+    values = rng.normal(size=20000)
+    values[::97] = np.nan
+    whole = engine.Decimator(['v'])
+    whole.extend({'index': np.arange(20000), 'v': values}, 0)
+    parts = engine.Decimator(['v'])
+    cuts = np.r_[0, np.sort(rng.choice(np.arange(1, 20000), 100, replace=False)), 20000]
+    for lo, hi in zip(cuts[:-1], cuts[1:]):
+        parts.extend({'index': np.arange(lo, hi), 'v': values[lo:hi]}, lo)
+    for max_points in [50, 500, 20000]:
+        x1, y1 = whole.fetch('index', ['v'], max_points=max_points)
+        x2, y2 = parts.fetch('index', ['v'], max_points=max_points)
+        assert np.array_equal(x1, x2)
+        assert np.array_equal(y1['v'], y2['v'], equal_nan=True)
+
+
+def test_decimator_envelope_keeps_extremes():
+    values = np.zeros(64 * 400)
+    values[12345] = 9.0
+    values[20000] = -9.0
+    decimator = engine.Decimator(['v'])
+    decimator.extend({'index': np.arange(len(values)), 'v': values}, 0)
+    x, ys = decimator.fetch('index', ['v'], max_points=100)
+    assert len(x) <= 100
+    assert ys['v'].max() == 9.0
+    assert ys['v'].min() == -9.0
+
+
+# capture files
+
+def write_capture(filename, rows, per_batch=100, **kwargs):
+    capture = engine.Capture(filename, make_header([('t', 'integer'), ('v', 'real')]), **kwargs)
+    capture.open()
+    for lo in range(0, rows, per_batch):
+        capture.add([json.dumps({'t': i, 'v': i / 10}) for i in range(lo, min(lo + per_batch, rows))],
+                    lo, 1e9 + lo)
+        capture.commit()
+    capture.close()
+    return capture
+
+
+@pytest.mark.parametrize('suffix', ['.db', '.cols'])
+def test_catalog_reads_across_segments(tmp_path, monkeypatch, suffix):
+    monkeypatch.setattr(engine.Capture, 'SEGMENT_BYTES', 1)
+    filename = str(tmp_path / f'seg{suffix}')
+    write_capture(filename, 1000)
+    catalog = engine.Catalog.load(filename)
+    entries = catalog.entries()
+    assert len(entries) >= 10
+    assert [e['row0'] for e in entries[1:]] == [e['row0'] + e['rows'] for e in entries[:-1]]
+    assert catalog.n_rows == 1000
+
+    cols = list(engine.read_columns(catalog, ['t'], start=150, stop=850, step=7))
+    t = np.concatenate([c['t'] for c in cols])
+    assert t.tolist() == list(range(150, 850, 7))
+    assert np.concatenate([c['index'] for c in cols]).tolist() == t.tolist()
+
+    opened = []
+    store = catalog.store
+    monkeypatch.setattr(catalog, 'store', lambda entry: opened.append(entry['file']) or store(entry))
+    cols = list(engine.read_columns(catalog, ['v'], x='t', x0=420, x1=430))
+    assert np.concatenate([c['v'] for c in cols]).tolist() == pytest.approx([i / 10 for i in range(420, 431)])
+    # only the segments holding t 420 to 430 (rows 420 to 430) are opened
+    assert opened == [e['file'] for e in entries if e['row0'] <= 430 and e['row0'] + e['rows'] > 420]
+
+
+def test_saved_buckets_rebuild_the_decimator(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine.Capture, 'SEGMENT_BYTES', 20000)
+    filename = str(tmp_path / 'b.db')
+    capture = write_capture(filename, 5000, per_batch=500)
+    catalog = engine.Catalog.load(filename)
+    assert len(catalog.entries()) > 1
+    assert all((tmp_path / (e['file'] + '.buckets.npz')).exists() for e in catalog.entries() if e['rows'])
+
+    read = []
+    monkeypatch.setattr(engine, 'read_columns', lambda *args, **kwargs: read.append(args) or iter(()))
+    decimator = engine.extend_decimator(engine.Decimator(capture.decimator.names), catalog.header, catalog)
+    assert read == []
+    assert decimator.n_rows == 5000
+    for name in ['t', 'v']:
+        x1, y1 = decimator.fetch('index', [name], max_points=100)
+        x2, y2 = capture.decimator.fetch('index', [name], max_points=100)
+        assert np.array_equal(x1, x2)
+        assert np.allclose(y1[name], y2[name])
+
+
+# clock alignment
+
+def test_clock_fit_drift_and_reset():
+    clock = engine.ClockFit('t_us')
+    ticks = np.arange(0, 10_000_000, 10_000, dtype=float)
+    host = 1000 + ticks * 1e-6 / (1 + 50e-6)
+    for lo in range(0, len(ticks), 100):
+        clock.update(ticks[lo:lo + 100], host[lo:lo + 100])
+    summary = clock.summary()
+    assert summary['n'] == len(ticks)
+    assert summary['drift_ppm'] == pytest.approx(50, abs=0.01)
+    assert summary['jitter_ms'] < 1e-3
+    # the device restarted, its clock counts from zero again
+    clock.update(ticks[:10], host[-1] + 1 + ticks[:10] * 1e-6)
+    assert clock.summary()['n'] == 10
+
+
+# derived channels
+
+def test_compile_derived_evaluates_per_batch():
+    evaluate = engine.compile_derived('abs(a - b) / 2 + 1e-3 * c ** 2', ['a', 'b', 'c'])
+    columns = {'index': np.arange(3), 'a': np.array([1.0, 2.0, np.nan]), 'b': np.array([3.0, 1.0, 1.0]),
+               'c': np.array([1, 2, 3])}
+    out = evaluate(columns)
+    assert out.dtype == float
+    assert out[:2].tolist() == pytest.approx([1.001, 0.504])
+    assert np.isnan(out[2])
+    assert engine.compile_derived('2', ['a'])(columns).tolist() == [2.0, 2.0, 2.0]
+    assert engine.compile_derived('a / 0', ['a'])(columns)[0] == np.inf
+
+
+@pytest.mark.parametrize('expr', ['a.real', '__import__("os")', 'open(a)', 'b + 1', '"x"', 'a if a else 1',
+                                  'lambda: a', 'a +'])
+def test_compile_derived_rejects(expr):
+    with pytest.raises(ValueError):
+        engine.compile_derived(expr, ['a'])